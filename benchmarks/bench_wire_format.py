@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Compare parameter server wire formats on a real parameters file.
+
+Times encoding and decoding of a full `parameters` snapshot and of a one-parameter `parameters_patch`, and reports
+the payload size, for:
+    * nested JSON (the original format: the parameters dict is a JSON string inside the JSON message),
+    * the "parameters.json" subprotocol (protocol.py, still nested for compatibility),
+    * the "parameters.msgpack" subprotocol (if `msgpack` is installed).
+
+Usage:
+    python benchmarks/bench_wire_format.py [parameters file] [-n repeats]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from definitions import DEFAULT_PARAMETERS_DIR
+from protocol import JSON, MSGPACK, decode, encode, msgpack
+
+
+def load_parameters(file_name):
+    with open(file_name, 'rt') as f:
+        array_form = json.load(f)
+    return {p['Name']: p for p in array_form['parameters']}
+
+
+def nested_json_encode(message):
+    return json.dumps({**message, "parameters": json.dumps(message["parameters"])})
+
+
+def nested_json_decode(frame):
+    message = json.loads(frame)
+    message["parameters"] = json.loads(message["parameters"])
+    return message
+
+
+def bench(label, message, encoder, decoder, number):
+    frame = encoder(message)
+    size = len(frame.encode("utf-8") if isinstance(frame, str) else frame)
+    t_encode = min(timeit.repeat(lambda: encoder(message), number=number, repeat=5)) / number
+    t_decode = min(timeit.repeat(lambda: decoder(frame), number=number, repeat=5)) / number
+    print("{0:<28} {1:>9d} B {2:>10.1f} us {3:>10.1f} us".format(label, size, t_encode * 1e6, t_decode * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parameter server wire formats.")
+    parser.add_argument("file", nargs="?", default=os.path.join(DEFAULT_PARAMETERS_DIR, "params_4Target-MID.json"),
+                        help="Parameters file to encode (default: params_4Target-MID.json).")
+    parser.add_argument("-n", type=int, default=200, help="Encodes/decodes per timing run.")
+    args = parser.parse_args()
+
+    parameters = load_parameters(args.file)
+    name = next(iter(parameters))
+    snapshot = {"type": "parameters", "has_data": True, "parameters": parameters, "revision": 1, "epoch": "0" * 32}
+    patch = {"type": "parameters_patch", "patch": {name: {"Value": parameters[name]["Value"]}}, "removed": [],
+             "revision": 2}
+
+    formats = [("nested JSON", nested_json_encode, nested_json_decode),
+               (JSON, lambda m: encode(m, JSON), decode)]
+    if msgpack is not None:
+        formats.append((MSGPACK, lambda m: encode(m, MSGPACK), decode))
+    else:
+        print("msgpack is not installed; skipping {0}.".format(MSGPACK))
+
+    print("{0} ({1} parameters)".format(os.path.basename(args.file), len(parameters)))
+    print("{0:<28} {1:>11} {2:>13} {3:>13}".format("format", "size", "encode", "decode"))
+    print("-- snapshot")
+    for label, encoder, decoder in formats:
+        bench(label, snapshot, encoder, decoder, args.n)
+    print("-- one-parameter patch")
+    for label, encoder, decoder in formats:
+        if label != "nested JSON":  # Patches were never nested.
+            bench(label, patch, encoder, decoder, args.n * 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Load test for the parameter server.
+
+Starts `server.py` on loopback (in memory, on a free port), loads a parameters file into it, and then runs:
+    * N editors, each changing one parameter of its own at a fixed rate and sending a `set_task` every so often. By
+      default every edit is a `patch_parameters` with just the changed field, like the GUI sends; with
+      `--edit-mode set` editors send the whole parameters dict with `set_parameters` instead;
+    * M readers that connect and say `hello` like `GameParameters`, and time every edit that reaches them.
+
+Each edit stamps the `Description` of the editor's parameter with its sequence number, so readers can match what they
+receive to when it was sent (editors and readers share one clock, since they run in this process). At the end it
+reports edits sent and delivered per second, p50/p95/p99 end-to-end propagation latency and the server's CPU use.
+
+Usage:
+    python benchmarks/load_test.py [-f params_4Target-MID.json] [--editors 2] [--readers 20] [--rate 20] [--duration 10]
+                                   [--edit-mode {patch,set}]
+
+All clients share this process, so with many hundreds of them the load test itself can become the bottleneck; watch
+that the delivered rate keeps up with editors x rate x readers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+import websockets
+from definitions import DEFAULT_PARAMETERS_DIR
+from protocol import JSON, MSGPACK, SUBPROTOCOLS, decode, encode
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MARKER = "load-test"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def load_parameters(file_name):
+    if not os.path.exists(file_name):
+        file_name = os.path.join(DEFAULT_PARAMETERS_DIR, file_name)
+    with open(file_name, 'rt') as f:
+        array_form = json.load(f)
+    return {p['Name']: p for p in array_form['parameters']}
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.uri = None
+        self.parameters = load_parameters(args.file)
+        # Each editor owns one parameter, so edits from different editors never overwrite each other.
+        self.owned = list(self.parameters)[:args.editors]
+        self.sent = {}          # (name, sequence) -> send time
+        self.latencies = []     # seconds, one per edit per reader
+        self.last_seen = {}     # reader -> {name: last sequence seen}
+        self.n_sent = 0
+        self.n_delivered = 0
+        self.measuring = False
+
+    def subprotocols(self):
+        return [MSGPACK] if self.args.binary else [JSON]
+
+    async def connect(self):
+        return await websockets.connect(self.uri, subprotocols=self.subprotocols(), max_size=None)
+
+    async def editor(self, index, stop):
+        name = self.owned[index]
+        # Editors share one up-to-date dict, like GUIs kept in sync by the server; in "set" mode a stale copy would send
+        # the other editors' parameters back to old values.
+        parameters = self.parameters
+        ws = await self.connect()
+        sequence = 0
+        period = 1 / self.args.rate
+        next_send = time.perf_counter()
+        try:
+            while not stop.is_set():
+                sequence += 1
+                parameters[name] = {**parameters[name], "Description": "{0} {1}".format(MARKER, sequence)}
+                if self.measuring:
+                    self.sent[(name, sequence)] = time.perf_counter()
+                    self.n_sent += 1
+                if self.args.edit_mode == "patch":
+                    message = {"type": "patch_parameters", "patch": {name: {"Description": parameters[name]["Description"]}}}
+                else:
+                    message = {"type": "set_parameters", "parameters": parameters}
+                await ws.send(encode(message, ws.subprotocol))
+                if self.args.task_every and sequence % self.args.task_every == 0:
+                    await ws.send(encode({"type": "set_task", "task": "task {0}".format(sequence)}, ws.subprotocol))
+                next_send += period
+                await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+        finally:
+            await ws.close()
+
+    def received(self, reader, name, description):
+        if not (isinstance(description, str) and description.startswith(MARKER)):
+            return
+        sequence = int(description.split()[1])
+        seen = self.last_seen[reader]
+        previous = seen.get(name, 0)
+        seen[name] = max(previous, sequence)
+        now = time.perf_counter()
+        # Edits merged into one update (coalescing, or a slow reader catching up) arrive together.
+        for s in range(previous + 1, sequence + 1):
+            sent_at = self.sent.get((name, s))
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+                self.n_delivered += 1
+
+    async def reader(self, index, stop):
+        self.last_seen[index] = {}
+        ws = await self.connect()
+        await ws.send(encode({"type": "hello", "since": None, "epoch": None}, ws.subprotocol))
+        try:
+            while not stop.is_set():
+                try:
+                    data = decode(await asyncio.wait_for(ws.recv(), 0.5))
+                except asyncio.TimeoutError:
+                    continue
+                if data["type"] == "parameters_patch":
+                    for (name, fields) in data["patch"].items():
+                        if name in self.owned:
+                            self.received(index, name, fields.get("Description"))
+                elif data["type"] == "parameters" and data["has_data"]:
+                    for name in self.owned:
+                        self.received(index, name, data["parameters"].get(name, {}).get("Description"))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            await ws.close()
+
+    async def run(self, server):
+        # Seed the session so every reader starts from the full state.
+        ws = await self.connect()
+        await ws.send(encode({"type": "set_parameters", "parameters": self.parameters}, ws.subprotocol))
+        await ws.close()
+        stop = asyncio.Event()
+        readers = [asyncio.ensure_future(self.reader(i, stop)) for i in range(self.args.readers)]
+        await asyncio.sleep(0.5)
+        editors = [asyncio.ensure_future(self.editor(i, stop)) for i in range(len(self.owned))]
+        await asyncio.sleep(self.args.warmup)
+        self.measuring = True
+        cpu_start, t_start = server_cpu(server), time.perf_counter()
+        await asyncio.sleep(self.args.duration)
+        self.measuring = False
+        cpu_end, t_end = server_cpu(server), time.perf_counter()
+        await asyncio.sleep(1.0)  # Let in-flight edits arrive.
+        stop.set()
+        await asyncio.gather(*editors, *readers)
+        return t_end - t_start, (None if cpu_start is None else cpu_end - cpu_start)
+
+
+def server_cpu(server):
+    """CPU seconds used by the server process so far (None without psutil)."""
+    if psutil is None:
+        return None
+    times = psutil.Process(server.pid).cpu_times()
+    return times.user + times.system
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the parameter server with simulated editors and readers.")
+    parser.add_argument("-f", "--file", default="params_4Target-MID.json",
+                        help="Parameters file (path, or name of a file in default_parameters/) used as the state.")
+    parser.add_argument("--editors", type=int, default=2, help="Simulated GUI editors.")
+    parser.add_argument("--readers", type=int, default=20, help="Simulated GameParameters readers.")
+    parser.add_argument("--rate", type=float, default=20, help="Edits per second sent by each editor.")
+    parser.add_argument("--task-every", type=int, default=50, help="Each editor also sends set_task every this many edits (0: never).")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to measure for.")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds to run before measuring.")
+    parser.add_argument("--edit-mode", choices=("patch", "set"), default="patch",
+                        help="Send each edit as a one-field patch_parameters (like the GUI) or as a full set_parameters.")
+    parser.add_argument("--binary", action="store_true", help="Use the MessagePack subprotocol instead of JSON.")
+    parser.add_argument("--server-args", default="", help="Extra arguments for server.py, e.g. \"--coalesce-ms 0\".")
+    args = parser.parse_args()
+    if args.binary and MSGPACK not in SUBPROTOCOLS:
+        parser.error("--binary needs msgpack installed.")
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "server.py"), "--host", "127.0.0.1",
+                               "--port", str(port), "--in-memory"] + args.server_args.split(),
+                              cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    test = LoadTest(args)
+    test.uri = "ws://127.0.0.1:{0}/load-test".format(port)
+    try:
+        for _ in range(100):  # Wait for the server to listen.
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        elapsed, cpu = asyncio.run(test.run(server))
+    finally:
+        server.terminate()
+        server.wait()
+    if cpu is None and resource is not None:
+        # Without psutil, fall back to the server's total CPU time (including start-up) once it has exited.
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = usage.ru_utime + usage.ru_stime
+        cpu_report = "{0:.2f} s total (install psutil for the measured interval only)".format(cpu)
+    else:
+        cpu_report = "n/a" if cpu is None else "{0:.2f} s ({1:.0f}% of one core)".format(cpu, 100 * cpu / elapsed)
+
+    expected = test.n_sent * args.readers
+    print("{0}: {1} parameters, {2} editors x {3:g}/s ({4}), {5} readers, {6}".format(
+        os.path.basename(args.file), len(test.parameters), len(test.owned), args.rate,
+        "patch_parameters" if args.edit_mode == "patch" else "set_parameters", args.readers,
+        MSGPACK if args.binary else JSON))
+    print("edits sent:       {0:>10.1f} /s".format(test.n_sent / elapsed))
+    print("edits delivered:  {0:>10.1f} /s  ({1} of {2})".format(test.n_delivered / elapsed, test.n_delivered, expected))
+    for q in (50, 95, 99):
+        print("latency p{0}:      {1:>10.2f} ms".format(q, 1000 * percentile(test.latencies, q)))
+    print("server CPU:       {0}".format(cpu_report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Module containing the long-lived parameter server connection used by the parameters interface.
+
+Note:
+    - The Tk thread never touches the network: `ServerConnection.send` hands a message to a background thread and
+      returns at once, and whatever the server sends back waits in `inbox` until the Tk thread collects it with
+      `poll` (e.g. from an `after` callback).
+"""
+import asyncio
+import itertools
+import queue
+import threading
+import websockets
+from collections import deque
+from protocol import SUBPROTOCOLS, decode, encode
+
+
+class ServerConnection(object):
+    """One websocket connection to the parameter server, kept open (and reopened) by a background asyncio thread."""
+    def __init__(self, uri: str, reconnect_delay: float = 1.0):
+        """Start connecting to the parameter server in the background.
+
+        Messages sent while the server is unreachable are buffered. Every message is tagged with a request `id` and
+        kept until the server acknowledges it, so anything sent or buffered before a dropped connection is replayed,
+        in order, as soon as the connection is back.
+
+        :param uri: Websocket URI of the parameter server session, e.g. "ws://128.2.244.29:6789/rig/3".
+        :param reconnect_delay: Seconds to wait between connection attempts.
+        :type uri: str
+        :type reconnect_delay: float
+        """
+        self.uri = uri
+        self.reconnect_delay = reconnect_delay
+        self.inbox = queue.Queue()  # Messages from the server, for the Tk thread
+        self.connected = False
+        self._outbox = deque()      # (id, message) not yet acknowledged by the server, oldest first
+        self._ids = itertools.count(1)
+        self._wakeup = None
+        self._loop = asyncio.new_event_loop()
+        self._task = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, message: dict) -> None:
+        """Queue a message for the server without blocking (safe to call from any thread).
+
+        :param message: The message, e.g. {"type": "set_task", "task": "demo"}. Do not modify it after sending.
+        :type message: dict
+        """
+        self._loop.call_soon_threadsafe(self._enqueue, message)
+
+    def poll(self) -> list:
+        """Return (and remove) every message received from the server since the last call.
+
+        :returns: Decoded server messages, oldest first.
+        :rtype: list
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.inbox.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def close(self) -> None:
+        """Stop the background thread (anything still unacknowledged is discarded)."""
+        self._loop.call_soon_threadsafe(self._cancel)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._task = self._loop.create_task(self._connect_forever())
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+
+    def _cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _enqueue(self, message):
+        self._outbox.append((next(self._ids), message))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _connect_forever(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                async with websockets.connect(self.uri, subprotocols=SUBPROTOCOLS) as ws:
+                    self.connected = True
+                    tasks = [asyncio.ensure_future(self._write(ws)), asyncio.ensure_future(self._read(ws))]
+                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in pending:
+                        task.cancel()
+                    for task in done:
+                        task.result()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                # Unreachable, timed out, refused or cut off during the handshake, or dropped later: try again.
+                pass
+            finally:
+                self.connected = False
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _write(self, ws):
+        last_sent = 0  # Nothing has been sent on a new connection yet, so unacknowledged messages go out again.
+        while True:
+            self._wakeup.clear()
+            for (request_id, message) in list(self._outbox):
+                if request_id > last_sent:
+                    await ws.send(encode({**message, "id": request_id}, ws.subprotocol))
+                    last_sent = request_id
+            await self._wakeup.wait()
+
+    async def _read(self, ws):
+        async for frame in ws:
+            data = decode(frame)
+            if "id" in data:
+                # Replies come back in request order, so this one settles everything up to its id.
+                while self._outbox and self._outbox[0][0] <= data["id"]:
+                    self._outbox.popleft()
+                if data["type"] == "ack":
+                    continue
+            self.inbox.put(data)
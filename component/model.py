@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Module containing the parameters model: the contents of a parameters file, independent of any interface.
+
+Note:
+    - Nothing here imports tkinter, so parameters files can be loaded, patched, filtered by task and exported without
+      a display (see export_parameters.py).
+    - The parameters interface (component.parameters_ui) shows a `ParameterModel`: edits made in its widgets are
+      written back with `patch`, and anything else that patches the model is pushed to the widgets by a listener.
+"""
+import json
+import os
+import sys
+from collections.abc import MutableMapping
+from os import path, scandir
+from time import strftime
+from uuid import uuid4
+
+
+FILENAME_DELIMITER = "_"  # Delimiter for filename metadata elements (see ParameterModel.session_name)
+# Fields of a parameter that get a slot in `Parameter`; anything else goes in a per-record dict.
+FIELDS = ("Name", "Type", "Page", "Task", "Value", "Options", "Bounds", "Increment", "Units", "Description", "PageIndex")
+INTERNED_FIELDS = ("Type", "Page", "Units", "Description")  # Strings shared by many parameters (and parameter sets)
+
+_FIELDS = frozenset(FIELDS)
+_INTERNED_FIELDS = frozenset(INTERNED_FIELDS)
+_KEY_ORDERS = {}  # Every distinct key order, so that records with the same keys share one tuple
+
+
+class Parameter(MutableMapping):
+    """One parameter: a dict-like record with a slot for each of the standard FIELDS.
+
+    It reads and writes like the parameter dict in a parameters file (`p['Value']`, `p.get('Options')`, `**p`,
+    `dict(p)`), and iterates over its keys in the order they were set, so `json.dump(dict(p))` writes exactly what was
+    loaded. Compared with a dict it needs no hash table per parameter, fields that are absent cost nothing, and the
+    strings repeated across parameters (INTERNED_FIELDS and the task names in 'Task') are interned, so that parameter
+    sets kept side by side share them.
+    """
+    __slots__ = FIELDS + ("_keys", "_extra")
+
+    def __init__(self, *args, **kwargs):
+        """Create a parameter record, taking the same arguments as `dict`.
+
+        :param args: (Optional) a mapping or iterable of (key, value) pairs, e.g. a parameter dict from a *.json file.
+        :param kwargs: (Optional) more fields.
+        """
+        self._keys = ()
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, k):
+        if k in _FIELDS:
+            try:
+                return getattr(self, k)
+            except AttributeError:
+                raise KeyError(k) from None
+        if self._extra is None:
+            raise KeyError(k)
+        return self._extra[k]
+
+    def __setitem__(self, k, v):
+        if k in _FIELDS:
+            if k in _INTERNED_FIELDS and type(v) is str:
+                v = sys.intern(v)
+            elif k == "Task" and type(v) is list:
+                v = [sys.intern(t) if type(t) is str else t for t in v]
+            setattr(self, k, v)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[k] = v
+        if k not in self._keys:
+            keys = self._keys + (k,)
+            self._keys = _KEY_ORDERS.setdefault(keys, keys)
+
+    def __delitem__(self, k):
+        if k not in self._keys:
+            raise KeyError(k)
+        if k in _FIELDS:
+            delattr(self, k)
+        else:
+            del self._extra[k]
+        keys = tuple(key for key in self._keys if key != k)
+        self._keys = _KEY_ORDERS.setdefault(keys, keys)
+
+    def __contains__(self, k):
+        return k in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self))
+
+    def copy(self) -> "Parameter":
+        """Return a shallow copy (like `dict.copy`)."""
+        return Parameter(self)
+
+
+def _next_index(directory: str, prefix: str, extension: str) -> int:
+    """One past the highest index of the `<prefix>NN<extension>` files in `directory` (0 if there are none)."""
+    index = 0
+    with scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.name.endswith(extension):
+                digits = entry.name[len(prefix):len(entry.name) - len(extension)]
+                if digits.isascii() and digits.isdigit():
+                    index = max(index, int(digits) + 1)
+    return index
+
+
+def _write_temporary(directory: str, name: str, data) -> str:
+    """Write `data` as JSON to a new hidden file in `directory`, flushed to disk, and return its name."""
+    tmp = path.join(directory, ".{0}.{1}.tmp".format(name, uuid4().hex))
+    f = open(tmp, 'x')  # Usual permissions (unlike tempfile.mkstemp, which makes the file private)
+    try:
+        with f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp
+
+
+def next_filename(directory: str, stem: str, extension: str = ".json") -> str:
+    """Name of the next free `<stem>_NN<extension>` file in `directory`, found with one scan; nothing is created.
+
+    Another rig saving to the same folder may take the name before it is written; write_new_json claims the next free
+    name as it writes, so use that to save.
+
+    :param directory: Folder the file would go in (need not exist yet).
+    :param stem: File name before the delimiter and index.
+    :param extension: File name extension.
+    :type directory: str
+    :type stem: str
+    :type extension: str
+    :returns: Full name of the file.
+    :rtype: str
+    """
+    prefix = stem + FILENAME_DELIMITER
+    index = _next_index(directory, prefix, extension) if path.isdir(directory) else 0
+    return path.join(directory, prefix + '{0:02d}'.format(index) + extension)
+
+
+def allocate_filename(directory: str, stem: str, extension: str = ".json") -> str:
+    """Create the next free `<stem>_NN<extension>` file in `directory` (empty) and return its name.
+
+    One scan of the directory finds the highest index already used, whatever the number of files, and creating the
+    file exclusively (mode 'x') reserves the name, so two rigs saving to a shared folder can never get the same one.
+    To save parameters under such a name, use write_new_json, which never leaves an empty file behind.
+
+    :param directory: Folder the file goes in (must exist).
+    :param stem: File name before the delimiter and index.
+    :param extension: File name extension.
+    :type directory: str
+    :type stem: str
+    :type extension: str
+    :returns: Full name of the new file.
+    :rtype: str
+    """
+    prefix = stem + FILENAME_DELIMITER
+    index = _next_index(directory, prefix, extension)
+    while True:
+        filename = path.join(directory, prefix + '{0:02d}'.format(index) + extension)
+        try:
+            with open(filename, 'x'):
+                return filename
+        except FileExistsError:  # Someone else took it since the scan.
+            index += 1
+
+
+def write_new_json(directory: str, stem: str, data, extension: str = ".json") -> str:
+    """Write `data` to the next free `<stem>_NN<extension>` file in `directory` and return its name.
+
+    The JSON is written (and flushed to disk) under a temporary name first; the free name is then claimed with a hard
+    link, which fails if the name is taken, so the file appears complete or not at all and two rigs saving to a shared
+    folder can never get the same name. On a file system without hard links the name is reserved (see
+    allocate_filename) and the temporary file renamed over it. Safe to call from a worker thread.
+
+    :param directory: Folder the file goes in (must exist).
+    :param stem: File name before the delimiter and index.
+    :param data: Anything json.dump accepts.
+    :param extension: File name extension.
+    :type directory: str
+    :type stem: str
+    :type extension: str
+    :returns: Full name of the new file.
+    :rtype: str
+    """
+    prefix = stem + FILENAME_DELIMITER
+    tmp = _write_temporary(directory, prefix + extension, data)
+    try:
+        index = _next_index(directory, prefix, extension)
+        while True:
+            filename = path.join(directory, prefix + '{0:02d}'.format(index) + extension)
+            try:
+                os.link(tmp, filename)
+                return filename
+            except FileExistsError:  # Someone else took it since the scan.
+                index += 1
+            except (OSError, NotImplementedError):
+                filename = allocate_filename(directory, stem, extension)
+                os.replace(tmp, filename)
+                return filename
+    finally:
+        if path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_json(filename: str, data) -> None:
+    """Write `data` to a *.json file atomically: the file holds either its old contents or all of `data`, never part.
+
+    The JSON goes to a temporary file in the same folder, which is flushed to disk and then renamed over `filename`, so
+    a crash (or a full disk) mid-write leaves no truncated file behind. Safe to call from a worker thread.
+
+    :param filename: Name of the file to write (replaced if it exists).
+    :param data: Anything json.dump accepts.
+    :type filename: str
+    """
+    directory, name = path.split(path.abspath(filename))
+    tmp = _write_temporary(directory, name, data)
+    try:
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def group_by_page(parameters: dict) -> dict:
+    """Split the parameters dict into one dict per page (keeping the order of the parameters within each page).
+
+    :param parameters: Parameters dict, as in ParameterModel.parameters.
+    :type parameters: dict
+    :returns: Dict mapping each 'Page' value to a dict of the parameters on that page (the entries are not copied).
+    :rtype: dict
+    """
+    pages = {}
+    for (k, v) in parameters.items():
+        pages.setdefault(v['Page'], {})[k] = v
+    return pages
+
+
+class ParameterModel(object):
+    """Parameters (by 'Name'), plus the layout and icon named by the parameters file.
+
+    Add, replace or re-task parameters through `patch` or `replace` (rather than changing `parameters` directly), so
+    that the cached task views returned by `for_task` stay current.
+    """
+    def __init__(self, parameters: dict = None, layout: str = None, icon: str = None):
+        """Constructor for a parameters model.
+
+        :param parameters: Dict mapping each parameter 'Name' to its Parameter ('Type', 'Value', 'Task', ...).
+        :param layout: The 'layout' entry of the parameters file (layout file name), if any.
+        :param icon: The 'icon' entry of the parameters file (image name in assets), if any.
+        :type parameters: dict or None
+        :type layout: str or None
+        :type icon: str or None
+        """
+        self.parameters = {} if parameters is None else parameters
+        self.layout = layout
+        self.icon = icon
+        self._listeners = []
+        self._views = {}  # Task -> dict of the parameters used by that task (see for_task)
+
+    @classmethod
+    def load(cls, file) -> "ParameterModel":
+        """Load a *.json parameters file.
+
+        :param file: Name of the file, or the open file.
+        :type file: str or SupportsRead[Union[str, bytes]]
+        :returns: The parameters in the file.
+        :rtype: ParameterModel
+        """
+        if isinstance(file, str):
+            with open(file, 'rt') as f:
+                return cls.from_dict(json.load(f))
+        return cls.from_dict(json.load(file))
+
+    @classmethod
+    def from_dict(cls, array_form: dict) -> "ParameterModel":
+        """Create a model from the contents of a parameters file.
+
+        :param array_form: Dict with a 'parameters' list (or Name -> parameter dict) and optional 'layout' and 'icon'.
+        :type array_form: dict
+        :rtype: ParameterModel
+        """
+        params = array_form['parameters']  # Handles both lists and dict format parameters.
+        if type(params) is list:
+            parameters = {}
+            for p in params:
+                parameters[p['Name']] = Parameter(p)
+        else:
+            parameters = {k: Parameter(v) for (k, v) in params.items()}
+        return cls(parameters, layout=array_form.get('layout'), icon=array_form.get('icon'))
+
+    def copy(self) -> "ParameterModel":
+        """Return a model that can be patched without changing this one (listeners are not copied).
+
+        :rtype: ParameterModel
+        """
+        return ParameterModel({k: v.copy() for (k, v) in self.parameters.items()}, layout=self.layout, icon=self.icon)
+
+    @property
+    def layout_file(self) -> str or None:
+        """Full path of the layout file (or None if the parameters file does not name one)."""
+        if self.layout is None:
+            return None
+        return path.abspath(self.layout)
+
+    @property
+    def icon_file(self) -> str or None:
+        """Full path of the *.png icon (or None if the parameters file does not name one)."""
+        if self.icon is None:
+            return None
+        icon_file, _ = path.splitext(self.icon)
+        return path.abspath(path.join('assets', icon_file)) + ".png"
+
+    @property
+    def task(self) -> str or None:
+        """Value of the 'Task' parameter (or None if there is no such parameter)."""
+        if 'Task' not in self.parameters:
+            return None
+        return self.parameters['Task']['Value']
+
+    def for_task(self, task: str = None) -> dict:
+        """Return the parameters used by a task.
+
+        The dict is built once per task and reused until parameters are added or replaced, or their 'Task' changes.
+        It holds the same Parameter records as `parameters`, so it always shows current values; do not modify it.
+
+        :param task: Name of the task (default: the current `task`).
+        :type task: str or None
+        :returns: Dict of the parameters whose 'Task' list includes `task` (empty if there is no task).
+        :rtype: dict
+        """
+        if task is None:
+            task = self.task
+        view = self._views.get(task)
+        if view is None:
+            view = {}
+            if task is not None:
+                for (k, v) in self.parameters.items():
+                    if task in v['Task']:
+                        view[k] = v
+            self._views[task] = view
+        return view
+
+    def values(self, task: str = None) -> dict:
+        """Return only the 'Value' of each parameter used by a task.
+
+        :param task: Name of the task (default: the current `task`).
+        :type task: str or None
+        :rtype: dict
+        """
+        return {k: v['Value'] for (k, v) in self.for_task(task).items()}
+
+    def subscribe(self, listener) -> None:
+        """Call `listener(changed)` with the changed fields ({Name: {field: value}}) after every `patch`.
+
+        :param listener: Callback taking the dict of changed fields.
+        :type listener: function or (dict) -> None
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener) -> None:
+        """Stop calling a listener added with `subscribe`."""
+        self._listeners.remove(listener)
+
+    def patch(self, patch: dict, exclude=None) -> dict:
+        """Merge a Name -> fields patch (as in the parameter server's `patch_parameters`) into the parameters.
+
+        Existing parameter dicts are updated in place; names that do not exist yet are added.
+
+        :param patch: Dict mapping parameter names to the fields to set, e.g. {'Subject': {'Value': 'Rupert'}}.
+        :param exclude: (Optional) listener not to notify, e.g. the one whose widget made the change.
+        :type patch: dict
+        :returns: Only what actually changed.
+        :rtype: dict
+        """
+        changed = {}
+        for (name, fields) in patch.items():
+            entry = self.parameters.get(name)
+            if entry is None:
+                self.parameters[name] = Parameter(fields, Name=name)
+                changed[name] = fields
+                self._views.clear()
+                continue
+            fields = {k: v for (k, v) in fields.items() if k not in entry or entry[k] != v}
+            if fields:
+                entry.update(fields)
+                changed[name] = fields
+                if 'Task' in fields:
+                    self._views.clear()
+        if changed:
+            for listener in self._listeners:
+                if listener != exclude:
+                    listener(changed)
+        return changed
+
+    def replace(self, parameters: dict) -> None:
+        """Add or replace whole parameters, e.g. with the ones from the parameter server (listeners are not notified).
+
+        :param parameters: Dict mapping parameter names to their new parameter dicts (or Parameter records).
+        :type parameters: dict
+        """
+        for (name, entry) in parameters.items():
+            self.parameters[name] = entry if isinstance(entry, Parameter) else Parameter(entry)
+        self._views.clear()
+
+    def export(self, task: str = None) -> dict:
+        """Return the contents of a parameters file for these parameters.
+
+        :param task: (Optional) only export the parameters used by this task (default: export all of them).
+        :type task: str or None
+        :returns: Dict with 'parameters' (list), 'layout' and 'icon', ready for json.dump.
+        :rtype: dict
+        """
+        parameters = self.parameters if task is None else self.for_task(task)
+        return dict(parameters=[dict(p) for p in parameters.values()], layout=self.layout, icon=self.icon)
+
+    def save(self, filename: str, task: str = None) -> None:
+        """Write the parameters to a *.json file (atomically, see write_json).
+
+        :param filename: Name of the file to write.
+        :param task: (Optional) only save the parameters used by this task (default: save all of them).
+        :type filename: str
+        :type task: str or None
+        """
+        write_json(filename, self.export(task))
+
+    def save_new(self, directory: str, task: str = None) -> str:
+        """Write the parameters to a new session file in `directory` and return its name (see write_new_json).
+
+        :param directory: Folder the file goes in.
+        :param task: (Optional) only save the parameters used by this task (default: save all of them). The file is
+                     named for this task (default: the current `task`).
+        :type directory: str
+        :type task: str or None
+        :returns: Name of the new file: session_name, then a two-digit index, e.g. "..._03.json".
+        :rtype: str
+        """
+        return write_new_json(directory, self.session_name(task), self.export(task))
+
+    def session_name(self, task: str = None) -> str:
+        """Name of a session file of these parameters, without its index and extension.
+
+        The name is the ISO-8601 date, then the value of each parameter listed in the `Naming Variables` parameter
+        (just `Task` if there is none), all delimited by FILENAME_DELIMITER.
+
+        :param task: Name of the task, which decides if `Naming Variables` applies (default: the current `task`).
+        :type task: str or None
+        :rtype: str
+        """
+        value = strftime("%Y-%m-%d")
+        if "Naming Variables" in self.for_task(task):
+            schema = self.parameters["Naming Variables"]['Value']
+        else:
+            schema = ["Task"]
+        for k in schema:  # For each element in schema list, add delimited metadata to name
+            value = value + FILENAME_DELIMITER + str(self.parameters[k]['Value'])
+        return value
+
+    def filename(self, directory: str, task: str = None) -> str:
+        """Auto-parsed name for a new session file of these parameters in `directory` (one that does not exist yet).
+
+        Only the name is computed (see next_filename); save_new claims the next free name as it writes the file.
+
+        :param directory: Folder the file goes in.
+        :param task: Name of the task, which decides if `Naming Variables` applies (default: the current `task`).
+        :type directory: str
+        :type task: str or None
+        :returns: session_name, then a two-digit index, e.g. "..._03.json".
+        :rtype: str
+        """
+        return next_filename(directory, self.session_name(task))
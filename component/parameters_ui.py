@@ -11,21 +11,62 @@ Authors:
     - Jonathan Shulgach
     - Max Murphy
 """
-import asyncio, json, websockets
+import json
+from concurrent.futures import ThreadPoolExecutor
 from time import strftime
-from definitions import DEFAULT_PARAMETERS_DIR, DEFAULT_PARAMETERS_FILE, DEFAULT_LAYOUTS_DIR, SAVED_PARAMETERS_DIR, WEBSOCKET_IP, WEBSOCKET_PORT
+from definitions import DEFAULT_PARAMETERS_DIR, DEFAULT_PARAMETERS_FILE, DEFAULT_LAYOUTS_DIR, SAVED_PARAMETERS_DIR, WEBSOCKET_IP, WEBSOCKET_PORT, WEBSOCKET_SESSION
 from pymitter import EventEmitter
-from tkinter import N, S, E, W, StringVar, PhotoImage, messagebox
+from tkinter import N, S, E, W, VERTICAL, StringVar, PhotoImage, messagebox, ttk
 from tkinter.filedialog import askdirectory, askopenfile, askopenfilename
 from component.arg_formats import arrayType, tagsType
+from component.connection import ServerConnection
 from component.widgets import VALID_TYPES, parse_widget, raise_type_error
-from component.utilities import add_image_button, check_for_file, get_photo_image, json_array_2_params_property
+from component.model import FILENAME_DELIMITER, ParameterModel, group_by_page, write_new_json
+from component.utilities import add_image_button, check_for_file, get_photo_image
 from component.interfaces import ParentWindow, Pane, Page, app, myDecorations
 
 
+SERVER_POLL_MS = 50  # How often (ms) the Tk thread picks up messages from the parameter server connection
+PREFETCH_DELAY_MS = 10  # Pause (ms) between building one not-yet-opened tab and the next, so input stays responsive
+STRUCTURAL_FIELDS = ("Type", "Units", "Bounds", "Increment")  # Fields a widget cannot change after it is created
+SAVE_POLL_MS = 50  # How often (ms) the Tk thread checks on a save running in the background
+
+
 def ws_uri() -> str:
-    """Returns the URI for websocket given IP and port in definitions.py."""
-    return f"ws://{WEBSOCKET_IP}:{WEBSOCKET_PORT}"
+    """Returns the URI for websocket given IP, port and session in definitions.py."""
+    return f"ws://{WEBSOCKET_IP}:{WEBSOCKET_PORT}/{WEBSOCKET_SESSION}"
+
+
+def structure(entry: dict) -> tuple:
+    """Return the fields of a parameter that fix the kind of widget it needs (anything else can be set in place).
+
+    :param entry: The parameter dict.
+    :type entry: dict
+    :returns: Tuple of the STRUCTURAL_FIELDS values (None where missing).
+    :rtype: tuple
+    """
+    return tuple(entry.get(k) for k in STRUCTURAL_FIELDS)
+
+
+def changed_fields(entry: dict, p: dict) -> dict:
+    """Return the fields of widget dict `p` (from `ParamWidget.to_dict`) that differ from the stored parameter `entry`.
+
+    :param entry: The parameter as currently stored (and last sent to the server).
+    :param p: The parameter as reported by its widget.
+    :type entry: dict
+    :type p: dict
+    :returns: Dict of only the changed fields (empty if nothing changed).
+    :rtype: dict
+    """
+    fields = {}
+    for (k, v) in p.items():
+        if type(v) is tuple:  # ttk.Combobox reports its options as a tuple
+            v = list(v)
+        if v is None and entry.get(k) is None:
+            continue
+        if entry.get(k) != v:
+            fields[k] = v
+    return fields
 
 
 class TypedParameterPage(Page):
@@ -36,6 +77,7 @@ class TypedParameterPage(Page):
                  subtitle: str = "Parameters",
                  p_type: tagsType or arrayType or str = None,
                  n_per_column: int = 4,
+                 n_rows: int = 10,
                  emitter: EventEmitter = None,
                  **kwargs):
         """Subclass of `Page` that specializes in handling task meta-parameters.
@@ -45,6 +87,7 @@ class TypedParameterPage(Page):
         :param subtitle: Header at top of panel as a static label.
         :param p_type: Type of parameter ("Label" | "Dropdown" | "Scalar" | "Boolean" | "Array" | "Tags" | "Object")
         :param n_per_column: Number of parameter widgets per column (default: 4)
+        :param n_rows: Number of rows of parameter widgets shown at once; longer pages scroll (default: 10)
         :param emitter: (Optional) event emitter for handling updates.
         :param kwargs: (Optional) keyword argument dict for child widgets.
         :type notebook: Pane
@@ -52,6 +95,7 @@ class TypedParameterPage(Page):
         :type subtitle: str
         :type p_type: tagsType or arrayType or str
         :type n_per_column: int
+        :type n_rows: int
         :type emitter: EventEmitter or None
         :type kwargs: dict or None
         .. seealso:: component.layouts.Page, tkinter.Frame, ParametersParentWindow, tkinter.Toplevel
@@ -65,44 +109,188 @@ class TypedParameterPage(Page):
         self.emitter = emitter
         self.parameters = dict()
         self.n_per_column = n_per_column
+        self.n_rows = n_rows
         self.grid_columnconfigure(0, weight=1, minsize=self.width)
-        self.widgets = {}
+        self.widgets = {}  # Parameter name -> widget currently showing it
+        self.built = False  # Widgets are only created by `build`, e.g. the first time this tab is selected
+        self._rows = []  # Grid rows of (name, column, columnspan), see `build`
+        self._first_row = 0  # Index in self._rows of the top row shown (scrolling pages only)
+        self._pool = {}  # structure() -> hidden widgets that can be rebound to a parameter of that structure
+        self._scrollbar = None
         self._header_variable = StringVar()
         self.addTaskHeader(text=subtitle, textvariable=self._header_variable, anchor=E)
 
-    def init_parameters(self, parameters: dict) -> None:
-        """Initialize the page with correct widgets in grid.
+    def init_parameters(self, parameters: dict, lazy: bool = False) -> None:
+        """Initialize the page with its parameters, and (unless `lazy`) the correct widgets in grid.
 
-        :param parameters: Full dict of (default) parameters.
+        :param parameters: Dict of (default) parameters on this page (see component.model.group_by_page).
+        :param lazy: If True, leave creating the widgets to a later call of `build` (e.g. when the tab is selected).
         :type parameters: dict
-        .. seealso:: self.addParameter,
+        :type lazy: bool
+        .. seealso:: self.build
         """
-        self.parameters = parameters
-        layout = dict(row=0, rowspan=1, column=0, columnspan=1, sticky=(N, S, E, W))
+        self.parameters = dict(parameters)
 #         w = self.winfo_toplevel()
         w = self.master.master
+        idx = self.index()
         for name in parameters:
-            value = parameters[name]
-            if self.includes(p_page=value['Page']):
-                if layout['column'] == self.n_per_column:
-                    layout['column'] = 0
-                    layout['row'] += 1
-                n = self._increment_size[value['Type']](value)
-                layout['columnspan'] = n
-                # Add a mapping to associate this parameter to the correct page.
-                w.setParameterPageIndex(k=name, idx=self.index())
-                args = dict(name=name,
-                            layout=layout,
-                            emitter=self.emitter,
-                            font=myDecorations.font['SMALL'],
-                            **value)
-                # Create the correct type of widget for this parameter.
-                entry_widget = parse_widget(master=self.contents,
-                                            tooltip=self.tooltip,
-                                            **args)
-                # Add the parameter widget to the dictionary of all such widgets.
-                self.widgets[name] = entry_widget
-                layout['column'] += n
+            # Add a mapping to associate this parameter to the correct page.
+            w.setParameterPageIndex(k=name, idx=idx)
+        if not lazy:
+            self.build()
+
+    def build(self) -> None:
+        """Create this page's widgets in grid (only the first time it is called).
+
+        If the page has more than `n_rows` rows it scrolls: only the widgets of the rows in view exist, and widgets of
+        rows scrolled out of view are reused for the rows scrolled into view (see scrollTo).
+
+        :returns: None
+        :rtype: None
+        """
+        if self.built:
+            return
+        self.built = True
+        self._rows = []
+        column = self.n_per_column
+        for (name, value) in self.parameters.items():
+            if column == self.n_per_column:
+                column = 0
+                self._rows.append([])
+            n = self._increment_size[value['Type']](value)
+            self._rows[-1].append((name, column, n))
+            column += n
+        if len(self._rows) <= self.n_rows:
+            for (row, cells) in enumerate(self._rows):
+                for (name, column, n) in cells:
+                    # Add the parameter widget to the dictionary of all such widgets.
+                    self.widgets[name] = self._createWidget(name, row, column, n)
+            return
+        # Scrollbar goes to the right of the widest row.
+        last_column = max(column + n for cells in self._rows for (_, column, n) in cells)
+        self._scrollbar = ttk.Scrollbar(self.contents, orient=VERTICAL, command=self.onScroll)
+        self._scrollbar.grid(row=0, rowspan=self.n_rows, column=last_column, sticky=(N, S))
+        self.contents.grid_rowconfigure(tuple(range(self.n_rows)), weight=1)
+        self._bindMouseWheel(self.contents)
+        self.scrollTo(0)
+
+    def _createWidget(self, name: str, row: int, column: int, columnspan: int):
+        """Create the correct type of widget for a parameter at the given grid position."""
+        layout = dict(row=row, rowspan=1, column=column, columnspan=columnspan, sticky=(N, S, E, W))
+        args = dict(name=name,
+                    layout=layout,
+                    emitter=self.emitter,
+                    font=myDecorations.font['SMALL'],
+                    **self.parameters[name])
+        return parse_widget(master=self.contents,
+                            tooltip=self.tooltip,
+                            **args)
+
+    def scrollTo(self, first_row: int) -> None:
+        """Show `n_rows` rows of a scrolling page, starting at `first_row`.
+
+        Widgets of rows that leave the view are hidden and kept in a pool by structure(); rows that come into view
+        take a widget from the pool when one fits, so the number of widgets stays about the number of cells in view.
+
+        :param first_row: Index of the row to show at the top.
+        :type first_row: int
+        :returns: None
+        :rtype: None
+        """
+        first_row = max(0, min(first_row, len(self._rows) - self.n_rows))
+        rows = self._rows[first_row:first_row + self.n_rows]
+        visible = set(name for cells in rows for (name, _, _) in cells)
+        for name in [k for k in self.widgets if k not in visible]:
+            widget = self.widgets.pop(name)
+            widget.flush()  # A pending edit still belongs to this parameter.
+            widget.grid_remove()
+            self._pool.setdefault(structure(self.parameters[name]), []).append(widget)
+        for (row, cells) in enumerate(rows):
+            for (name, column, n) in cells:
+                widget = self.widgets.get(name)
+                if widget is None:
+                    pool = self._pool.get(structure(self.parameters[name]))
+                    if pool:
+                        widget = pool.pop()
+                        widget.rebind(**self.parameters[name])
+                    else:
+                        widget = self._createWidget(name, row, column, n)
+                        self._bindMouseWheel(widget)
+                    self.widgets[name] = widget
+                widget.grid(row=row, rowspan=1, column=column, columnspan=n, sticky=(N, S, E, W))
+        self._first_row = first_row
+        self._scrollbar.set(first_row / len(self._rows), (first_row + len(rows)) / len(self._rows))
+
+    def onScroll(self, *args) -> None:
+        """Scrollbar command: ('moveto', fraction) or ('scroll', n, 'units' | 'pages')."""
+        if args[0] == "moveto":
+            self.scrollTo(round(float(args[1]) * len(self._rows)))
+        elif args[0] == "scroll":
+            step = self.n_rows if args[2] == "pages" else 1
+            self.scrollTo(self._first_row + int(args[1]) * step)
+
+    def onMouseWheel(self, event) -> str:
+        """Scroll one row per wheel notch (`<MouseWheel>` on Windows/macOS, `<Button-4/5>` on X11)."""
+        up = event.num == 4 or (event.delta or 0) > 0
+        self.scrollTo(self._first_row + (-1 if up else 1))
+        return "break"
+
+    def _bindMouseWheel(self, widget) -> None:
+        """Scroll this page with the mouse wheel over `widget` or any of its children."""
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            widget.bind(sequence, self.onMouseWheel, add="+")
+        for child in widget.winfo_children():
+            self._bindMouseWheel(child)
+
+    def clear(self) -> None:
+        """Destroy all of this page's parameter widgets (including hidden ones), so that `build` starts over."""
+        for widget in list(self.widgets.values()) + [w for pool in self._pool.values() for w in pool]:
+            widget.destroy()
+        if self._scrollbar is not None:
+            self._scrollbar.destroy()
+            self._scrollbar = None
+        self.widgets = {}
+        self._pool = {}
+        self._first_row = 0
+        self.built = False
+
+    def reconcile(self, parameters: dict) -> None:
+        """Show new parameters on this page, updating the existing widgets in place where possible.
+
+        The widgets are only rebuilt if the page's structure changed (different parameters or order, or a different
+        value for one of the STRUCTURAL_FIELDS); otherwise only their values and descriptions are set.
+
+        :param parameters: Dict containing the parameters on this page (see component.model.group_by_page).
+        :type parameters: dict
+        :returns: None
+        :rtype: None
+        """
+        old = self.parameters
+        changed = list(old) != list(parameters) or any(structure(old[k]) != structure(v)
+                                                       for (k, v) in parameters.items())
+        was_built = self.built
+        self.init_parameters(parameters, lazy=True)
+        if changed:
+            self.clear()
+            if was_built:
+                self.build()
+            return
+        for (k, v) in parameters.items():
+            if k in self.widgets:
+                self.widgets[k].desc = v.get('Description', "")
+            self.setWidgetValue(k, v)
+
+    def flush(self, k: str = None) -> None:
+        """Commit edits still waiting in the debounce timer of this page's widgets.
+
+        :param k: (Optional) only flush the widget of this parameter.
+        :type k: str or None
+        :returns: None
+        :rtype: None
+        """
+        for (name, widget) in list(self.widgets.items()):
+            if k is None or name == k:
+                widget.flush()
 
     def includes(self, p_page: str) -> bool:
         """Check if typed parameter should be included on this page.
@@ -126,19 +314,18 @@ class TypedParameterPage(Page):
     def loadParameters(self, parameters: dict) -> None:
         """Load relevant parameter values for this page.
 
-        :param parameters: Dict containing parameters of all Type values.
+        :param parameters: Dict containing the parameters on this page (see component.model.group_by_page).
         :type parameters: dict
         :returns: None
         :rtype: None
         """
 #         w = self.winfo_toplevel()
         w = self.master.master
-        for k in parameters:
-            v = parameters[k]
-            if self.includes(p_page=v['Page']):
-                self.parameters[k] = v
-                self.setWidgetValue(k, v)
-                w.setParameterPageIndex(k=k, idx=self.index())
+        idx = self.index()
+        for (k, v) in parameters.items():
+            self.parameters[k] = v
+            self.setWidgetValue(k, v)
+            w.setParameterPageIndex(k=k, idx=idx)
 
     def setWidgetValue(self, k: str, v: dict) -> None:
         """Update an existing widget's value.
@@ -151,7 +338,10 @@ class TypedParameterPage(Page):
         :rtype: None
         .. seealso:: component.widgets
         """
+        if k not in self.widgets:  # Not built yet; `build` will use the value in self.parameters.
+            return
         self.widgets[k].value = v
+        self.widgets[k].mark_committed()  # A loaded value is not an edit, so it must not be emitted back.
 
     def getParameter(self, k: str) -> list or float or str or bool and list or None:
         """Return the `dynamic` value of a named parameter.
@@ -161,6 +351,9 @@ class TypedParameterPage(Page):
         :returns: The dynamic `Value` in named parameter dict related to key `k`.
         :rtype: list or float or str or bool and list or None
         """
+        if k not in self.widgets:  # Not built yet, so nothing can have been edited.
+            v = self.parameters[k]
+            return v['Value'], (v.get('Options') if v['Type'] in ("Dropdown", "DropdownTags") else None)
         if self.widgets[k].type not in ("Dropdown", "DropdownTags"):
             opts = None
         else:
@@ -222,6 +415,7 @@ class ParametersParentWindow(ParentWindow):
                  title: str = "Parameters Exporter",
                  width: int = 1028,
                  height: int = 720,
+                 prefetch_tabs: bool = True,
                  **kwargs):
         """Constructor for new Parameter window.
 
@@ -230,11 +424,13 @@ class ParametersParentWindow(ParentWindow):
         :param exit_command: Default is `self.on_closing` - what to do when Parameters UI is closed.
         :param width: Number of pixels wide the window should be.
         :param height: Number of pixels tall the window should be.
+        :param prefetch_tabs: Build the widgets of tabs that have not been opened yet while the window is idle.
         :param kwargs: Optional keyword arguments dict for Window.
         :type master: app or None
         :type defaults_name: str
         :type width: int
         :type height: int
+        :type prefetch_tabs: bool
         :type kwargs: dict or str or int or None
         :returns: None
         :rtype: None
@@ -274,48 +470,93 @@ class ParametersParentWindow(ParentWindow):
         self.task = None
         self.pgs = []
         self.notebooks = {}
+        self._page_parameters = {}  # Page title -> parameters on that page (see _loadLayout)
+        self._layout = None  # Contents of the layout file the current tabs were built from
         self.ready = False
+        # Writes parameters files in the background, one at a time and in order (see saveParameters).
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save")
+        self.prefetch_tabs = prefetch_tabs
+        self._synced = False  # True once in sync with the server: its parameters loaded, or ours sent (see handleServerMessage)
+        self.server = ServerConnection(ws_uri())
         
-        self._parameters, self._layout_file, self._icon_file = json_array_2_params_property(open(filename, 'rt'))
+        self.model = ParameterModel.load(filename)
+        self.model.subscribe(self.showChanges)
+        self._layout_file, self._icon_file = self.model.layout_file, self.model.icon_file
 #         self._addNotebook(title="Parameters", width=round(self.width*0.9), height=round(self.height*0.95))
         
-        self.task = self._parameters['Task']['Value']
-        self._loadLayout(self._parameters, **kwargs)
-        asyncio.get_event_loop().run_until_complete(self.updatePServerTask())
-
-    async def updatePServerParameters(self):
-        """Update the parameter server with new parameter object values."""
-        uri = ws_uri()
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(json.dumps({'type': 'set_parameters', 'parameters': json.dumps(self._parameters)}))
-            
-    async def updatePServerTask(self):
-        """Update the parameter server with new task name."""
-        uri = ws_uri()
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(json.dumps({'type': 'set_task', 'task': self.task}))
-            data = json.loads(await websocket.recv())
-            while not (data["type"] == "parameters"):
-                data = json.loads(await websocket.recv())
-            if data['has_data'] == True:
-                p = json.loads(data['parameters'])
-                for (k,v) in p.items():
-                    if k in self._parameters.keys():
-                        self._parameters[k] = {}
-                    self._parameters[k] = v
-                self._dropTabs()
-                self._loadLayout(self._parameters)
-                for p in self.pgs:
-                    # print(f'Loading {p.title} parameters...')
-                    p.loadParameters(self._parameters)
-            else:
-                print("Parameters not yet initialized.")
+        self.task = self.model.task
+        self._loadLayout(self.model.parameters, **kwargs)
+        self.updatePServerTask()
+        self.after(SERVER_POLL_MS, self.pollServer)
+
+    def updatePServerParameter(self, name: str, fields: dict) -> None:
+        """Send the changed fields of one parameter to the parameter server (returns without waiting on the network).
+
+        :param name: Name of the parameter.
+        :param fields: Only the fields that changed, e.g. {'Value': 5}.
+        :type name: str
+        :type fields: dict
+        """
+        self.server.send({'type': 'patch_parameters', 'patch': {name: fields}})
+
+    def updatePServerParameters(self) -> None:
+        """Send the whole parameter set to the parameter server (returns without waiting on the network).
+
+        Edits after this only send what changed (see updatePServerParameter).
+        """
+        self.server.send({'type': 'set_parameters',
+                          'parameters': {k: dict(v) for (k, v) in self.model.parameters.items()}})
+
+    def updatePServerTask(self):
+        """Update the parameter server with new task name (the server's parameters arrive later, see pollServer)."""
+        self.server.send({'type': 'set_task', 'task': self.task})
+
+    def pollServer(self):
+        """Handle whatever the parameter server sent since the last poll, then poll again after SERVER_POLL_MS."""
+        for data in self.server.poll():
+            self.handleServerMessage(data)
+        self.after(SERVER_POLL_MS, self.pollServer)
+
+    def handleServerMessage(self, data: dict) -> None:
+        """Act on one message from the parameter server (called on the Tk thread).
+
+        :param data: Decoded server message.
+        :type data: dict
+        """
+        if data["type"] == "parameters" and data['has_data'] != True:
+            # A new session, or the server came back without its state: it gets the whole set from us, since the
+            # patches sent for each edit only make sense on top of it.
+            self._synced = True
+            print("Parameters not yet initialized on the server; sending them.")
+            self.updatePServerParameters()
+        elif data["type"] == "parameters" and not self._synced:
+            # The first parameters from the server replace the ones loaded from file.
+            self._synced = True
+            self.model.replace(data['parameters'])
+            self._showParameters(self.model.parameters)
+        elif data["type"] == "error":
+            print("Parameter server: {0} {1}".format(data['error'], data.get('invalid', '')))
 
     def updateParameter(self, p):
         """Callback for updating a given parameter based on widget changes."""
         # print("Updated {0} to {1}.".format(p['Name'], p['Value']))
-        self._parameters[p['Name']]['Value'] = p['Value']
-        asyncio.get_event_loop().run_until_complete(self.updatePServerParameters())
+        fields = changed_fields(self.model.parameters[p['Name']], p)
+        if not fields:
+            return
+        # The widget already shows the change, so it is not pushed back to it.
+        self.model.patch({p['Name']: fields}, exclude=self.showChanges)
+        self.updatePServerParameter(p['Name'], fields)
+
+    def showChanges(self, changed: dict) -> None:
+        """Model listener: show parameters changed by `self.model.patch` in their widgets.
+
+        :param changed: Dict mapping each changed parameter name to its changed fields.
+        :type changed: dict
+        """
+        for name in changed:
+            entry = self.model.parameters[name]
+            if 'PageIndex' in entry and entry['PageIndex'] < len(self.pgs):
+                self.pgs[entry['PageIndex']].setWidgetValue(name, entry)
 
     def pageIndex(self, page) -> int:
         """Return index of page in self.pgs array (or None if not in array).
@@ -346,7 +587,8 @@ class ParametersParentWindow(ParentWindow):
             if file is None:
                 print("No file selected.")
                 return
-            parameters, self._layout_file, self._icon_file = json_array_2_params_property(file)
+            model = ParameterModel.load(file)
+            self._layout_file, self._icon_file = model.layout_file, model.icon_file
             if self._icon_file is not None:
                 pass
                 self.iconbitmap(self._icon_file)
@@ -354,19 +596,37 @@ class ParametersParentWindow(ParentWindow):
         elif type(parameters) is str:
             if not check_for_file(filename=parameters):
                 raise Exception("Could not find file <" + parameters + ">")
-            file = open(parameters, mode='rt')
-            parameters, self._layout_file, self._icon_file = json_array_2_params_property(file)
+            model = ParameterModel.load(parameters)
+            self._layout_file, self._icon_file = model.layout_file, model.icon_file
             if self._icon_file is not None:
                 # pass
                 self.iconbitmap(self._icon_file)
                 self.master.iconbitmap(self._icon_file)
-        self._dropTabs()
-        self._parameters = parameters
-        self._loadLayout(parameters)
-        for p in self.pgs:
-            # print(f'Loading {p.title} parameters...')
-            p.loadParameters(parameters)
+        else:
+            model = ParameterModel(parameters, layout=self.model.layout, icon=self.model.icon)
+        self.model.unsubscribe(self.showChanges)
+        self.model = model
+        self.model.subscribe(self.showChanges)
+        self._showParameters(self.model.parameters)
+        self.updatePServerParameters()
         print("Loading complete!")
+
+    def _showParameters(self, parameters: dict) -> None:
+        """Show new parameters, keeping the existing tabs and widgets if the layout is unchanged.
+
+        :param parameters: Dict with all parameters (the new self.model.parameters).
+        :type parameters: dict
+        .. seealso:: TypedParameterPage.reconcile
+        """
+        layout = self._readLayout()
+        if not self.pgs or layout != self._layout:
+            self._dropTabs()
+            self._loadLayout(parameters, layout=layout)
+            return
+        self._setIcon()
+        self._page_parameters = group_by_page(parameters)
+        for p in self.pgs:
+            p.reconcile(self._page_parameters.get(p.title, {}))
         
     def _dropTabs(self):
         """Drop existing tabs/notebooks."""
@@ -386,27 +646,42 @@ class ParametersParentWindow(ParentWindow):
             self.notebooks[key].destroy()
             _ = self.notebooks.pop(key, None)
         
-    def _loadLayout(self, parameters, **kwargs):
-        """Load layout after loading new parameters file."""
-            
-        # self._addNotebook(title="Parameters", width=round(self.width*0.9), height=round(self.height*0.95))
-        
+    def _readLayout(self) -> dict:
+        """Read the layout file (asking for one if the parameters file does not name it)."""
         if self._layout_file is None:
+            files = [('JavaScript Object Notation', '*.json'),
+                     ('Any File Type', '*.*')]
             self._layout_file = askopenfilename(title="Select parameters json file.",
                                                 initialdir=DEFAULT_LAYOUTS_DIR,
                                                 initialfile="layout.json",
                                                 multiple=False,
                                                 filetypes=files,
                                                 defaultextension=files)
+            self.model.layout = self._layout_file
+        with open(self._layout_file, mode="rt") as f:
+            return json.load(f)
+
+    def _setIcon(self):
+        """Use the icon of the current parameters file (if any) for the window."""
         if self._icon_file is not None:
             self.master.iconphoto(False, PhotoImage(file=self._icon_file))
             self.iconphoto(False, PhotoImage(file=self._icon_file))
-                    
-        layout = json.load(open(self._layout_file, mode="rt"))
+
+    def _loadLayout(self, parameters, layout: dict = None, **kwargs):
+        """Load layout after loading new parameters file."""
+            
+        # self._addNotebook(title="Parameters", width=round(self.width*0.9), height=round(self.height*0.95))
+        
+        if layout is None:
+            layout = self._readLayout()
+        self._layout = layout
+        self._setIcon()
 #         common_to_all_pages = dict(notebook=self.notebooks['Parameters'], emitter=self._emitter)
-        common_to_all_pages = dict(notebook=self._addNotebook(title="Parameters", width=round(self.width*0.9), height=round(self.height*0.95)), emitter=self._emitter)
+        notebook = self._addNotebook(title="Parameters", width=round(self.width*0.9), height=round(self.height*0.95))
+        common_to_all_pages = dict(notebook=notebook, emitter=self._emitter)
+        self._page_parameters = group_by_page(parameters)
             
-        # Populate list property with the new tabs
+        # Populate list property with the new tabs (their widgets are built when first selected; see onTabChanged)
         page_index = 0
         for individual_page_layout in layout['pages']:
             p = TypedParameterPage(**individual_page_layout, **common_to_all_pages, **kwargs)
@@ -419,12 +694,32 @@ class ParametersParentWindow(ParentWindow):
                         command=self.loadParameters)
             p.buttons["Exit"].configure(command=self.on_closing)
             self.pgs.append(p)
-            self.pgs[page_index].init_parameters(parameters=parameters)
+            self.pgs[page_index].init_parameters(parameters=self._page_parameters.get(p.title, {}), lazy=True)
             page_index += 1
+        notebook.bind("<<NotebookTabChanged>>", self.onTabChanged)
+        if notebook.select():
+            self.nametowidget(notebook.select()).build()
+        if self.prefetch_tabs:
+            self.after_idle(self.prefetchTabs)
+
+    def onTabChanged(self, event) -> None:
+        """Build the widgets of a tab the first time it is selected."""
+        self.nametowidget(event.widget.select()).build()
+
+    def prefetchTabs(self) -> None:
+        """Build the next tab that has not been opened yet, then schedule the one after that."""
+        for p in self.pgs:
+            if not p.built:
+                p.build()
+                self.after(PREFETCH_DELAY_MS, lambda: self.after_idle(self.prefetchTabs))
+                return
 
     def saveParameters(self):
         """Save parameters callback method.
 
+        The parameters (and the session name) are taken on the Tk thread; writing the file happens in the background
+        (see component.model.write_new_json) and `checkSave` reports when it is done.
+
         :returns: None
         :rtype: None
         """
@@ -432,53 +727,66 @@ class ParametersParentWindow(ParentWindow):
         if len(self._directory) == 0:
             print("Save canceled.")
             return
-        filename = self.name
-        f = open(filename, 'wt')
         out = self.formatParameters()
-        self._parameters.update(**data)
-        json.dump(out, f, indent=2)
-        self.ready = check_for_file(filename)
-        if self.ready:
-            print("Save successful!")
+        stem = self.model.session_name(self.task)
+        self.ready = False
+        self.after(SAVE_POLL_MS, self.checkSave, self._saver.submit(write_new_json, self._directory, stem, out))
+
+    def checkSave(self, future) -> None:
+        """Report on a save once its background write is done (checking again after SAVE_POLL_MS until then).
+
+        :param future: The write, as submitted to the saver; its result is the name of the new file.
+        :type future: concurrent.futures.Future
+        :returns: None
+        :rtype: None
+        """
+        if not future.done():
+            self.after(SAVE_POLL_MS, self.checkSave, future)
+            return
+        error = future.exception()
+        if error is None:
+            self.ready = True
+            print("Save successful! ({0})".format(future.result()))
+            return
+        print("Save failed: {0}".format(error))
+        messagebox.showerror("Save", "Could not save the parameters in {0}:\n{1}".format(self._directory, error))
 
     def formatParameters(self) -> dict:
-        """Return formatted/consolidated parameters dict object."""
-        out = dict(parameters=[])
-        data = {}
-        for k in self.parameters:
-            data[k] = self.getParameter(k)
-            out['parameters'].append(data[k])
-        out['layout'] = self._layout_file
-        out['icon'] = self._icon_file
-        return out
+        """Return formatted/consolidated parameters dict object (the current task's parameters)."""
+        self.flushWidgets()
+        return self.model.export(task=self.task)
+
+    def flushWidgets(self) -> None:
+        """Write edits still waiting in a widget's debounce timer to the model."""
+        for p in self.pgs:
+            p.flush()
 
     def getParameter(self, name: str) -> dict:
         """Return the dynamic parameter object by name and type.
 
         :param name: Key in fully-enumerated parameters dict (self.parameters)
         :type name: str
-        :returns: Dynamic value reflecting updates from parameters interface for that parameter.
+        :returns: Dynamic value reflecting updates from parameters interface for that parameter (a copy).
         :rtype: dict
 
         .. seealso:: Page, Panel
         """
-        if name not in self.parameters.keys():
+        if self.task is None or name not in self.model.for_task(self.task):
             msg = "Bad reference to parameter <" + name + "> (not in parameters enumeration dict)"
             raise Exception(msg)
-        value = self.parameters[name]
-        if 'Options' in value.keys():
-            value['Value'], value['Options'] = self.pgs[value['PageIndex']].getParameter(k=name)
-        else:
-            value['Value'], _ = self.pgs[value['PageIndex']].getParameter(k=name)
-        self.parameters[name] = value
-        return value
+        value = self.model.parameters[name]
+        if 'PageIndex' in value:
+            self.pgs[value['PageIndex']].flush(k=name)
+        return dict(value)
 
     def on_closing(self):
         """Callback that occurs when window close request is received."""
         if not self.ready:
             if messagebox.askokcancel("Quit", "Exit without saving parameters?"):
+                self.server.close()
                 self.master.destroy()
         else:
+            self.server.close()
             self.master.destroy()
 
     def setParameterPageIndex(self, k: str, idx: int) -> None:
@@ -491,7 +799,7 @@ class ParametersParentWindow(ParentWindow):
         :returns: None
         :rtype: None
         """
-        self._parameters[k]['PageIndex'] = idx
+        self.model.parameters[k]['PageIndex'] = idx
 
     @property
     def abbreviated_parameters(self) -> dict or None:
@@ -500,37 +808,31 @@ class ParametersParentWindow(ParentWindow):
         :returns: Abbreviated parameters dict
         :rtype: dict or None
         """
-        parameters = {}
-        if self.task is not None:
-            for (k, v) in self._parameters.items():
-                if self.task in v['Task']:
-                    parameters[k] = v['Value']
-        return parameters
+        if self.task is None:
+            return {}
+        return self.model.values(self.task)
 
     @property
     def parameters(self) -> dict or None:
         """Parameters property holds all the parameter-related information.
 
-        :returns: Parameters dict
+        :returns: Parameters dict for the current task (a copy, as plain dicts; the window itself reads self.model)
         :rtype: dict or None
         """
-        parameters = {}
-        if self.task is not None:
-            for (k, v) in self._parameters.items():
-                if self.task in v['Task']:
-                    parameters[k] = v
-        return parameters
+        if self.task is None:
+            return {}
+        return {k: dict(v) for (k, v) in self.model.for_task(self.task).items()}
 
     @parameters.setter
     def parameters(self, value: dict = None) -> None:
-        """Setting parameters property updates value of self._parameters.
+        """Setting parameters property updates value of self.model.parameters.
 
-        :param value: The new dict value of self._parameters.
+        :param value: The new dict value of self.model.parameters.
         :type value: dict or None
         """
         if value is not None:
             self.task = value['Task']['Value']
-            self._parameters.update(**value)
+            self.model.replace(value)
 
     @property
     def filename_delimiter(self) -> str:
@@ -540,7 +842,7 @@ class ParametersParentWindow(ParentWindow):
 
         .. seealso:: self.name
         """
-        return "_"
+        return FILENAME_DELIMITER
 
     @staticmethod
     def formatted_date() -> str:
@@ -559,21 +861,9 @@ class ParametersParentWindow(ParentWindow):
             If `Naming Variables` is missing, the following metadata parameters are required:
                 + Task
 
-        .. seealso:: self.loadParameters, self.saveParameters
+            This is only the next free name; saveParameters claims a name as it writes the file.
+
+        .. seealso:: self.loadParameters, self.saveParameters, component.model.ParameterModel.filename
         """
-        value = self.formatted_date()
-        delimiter = self.filename_delimiter
-        if "Naming Variables" in self.parameters.keys():
-            v = self.getParameter("Naming Variables")
-            schema = v['Value']
-        else:
-            schema = ["Task"]
-        for k in schema:  # For each element in schema list, add delimited metadata to name
-            v = self.getParameter(k)
-            value = value + delimiter + v['Value']
-        file_index = 0
-        filename = self._directory + "/" + value + delimiter + '{0:02d}'.format(file_index) + '.json'
-        while check_for_file(filename):  # While a file of that name exists, increment the index variable.
-            file_index += 1
-            filename = self._directory + "/" + value + delimiter + '{0:02d}'.format(file_index) + '.json'
-        return filename
+        self.flushWidgets()
+        return self.model.filename(self._directory, task=self.task)
@@ -9,11 +9,11 @@ Authors:
     - Jonathan Shulgach
     - Max Murphy
 """
-import json
 import cairosvg
 import io
 from sys import platform
 from component.callbacks import Callbacks
+from component.model import ParameterModel
 from definitions import ROOT_DIR
 from tkinter import Tk, Label, ttk, LabelFrame, Frame
 from PIL import Image, ImageTk  # (Pillow)
@@ -78,24 +78,10 @@ def json_array_2_params_property(file) -> dict and str or None and str or None:
     :type file: SupportsRead[Union[str, bytes]]
     :returns: Parameters dict as would be used in the Parameters UI main property field, and associated layout file name
     :rtype: dict and str or None and str or None
+    .. seealso:: component.model.ParameterModel
     """
-    array_form = json.load(file)
-    params = array_form['parameters']  # Handles both lists and dict format parameters.
-    if type(params) is list:
-        parameters = {}
-        for p in params:
-            parameters[p['Name']] = p
-    else:
-        parameters = array_form['parameters']
-    layout = None
-    if 'layout' in array_form.keys():
-        layout = array_form['layout']
-        layout = fix_path(layout)
-    icon_file = None
-    if 'icon' in array_form.keys():
-        icon_file, _ = path.splitext(array_form['icon'])
-        icon_file = fix_path(path.join('assets', icon_file)) + ".png"
-    return parameters, layout, icon_file
+    model = ParameterModel.load(file)
+    return model.parameters, model.layout_file, model.icon_file
 
 def fix_path(f: str) -> str:
     """Prepend the project root path to the file path string.
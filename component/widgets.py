@@ -6,13 +6,15 @@ Authors:
     - Jonathan Shulgach
     - Max Murphy
 """
+from collections.abc import Mapping
 from math import sqrt, floor, ceil
 from pymitter import EventEmitter
-from tkinter import ttk, Event, IntVar, StringVar
+from tkinter import ttk, Event, EventType, IntVar, StringVar
 from tkinter import N, S, E, W, colorchooser    # TODO: add color selection interface compatibility
 from component.interfaces import myDecorations
 from component.utilities import gen_range
 
+DEBOUNCE_MS = 300  # A widget's value must stay unchanged this long (ms) after the last input event before it is emitted.
 VALID_TYPES = ["Boolean",
                "Scalar",
                "Label",
@@ -220,6 +222,7 @@ class ParamJSONFormat(dict):
         """
         kw = locals()
         kw.pop('self')
+        kw.pop('__class__', None)  # Present in locals() because of the zero-argument super()
         super().__init__(**kw)
 
 
@@ -285,6 +288,8 @@ class ParamWidget(ttk.LabelFrame):
         myDecorations.addLabelFrameStyle()
         self.tooltip = tooltip
         self.emitter = emitter
+        self._label = lab
+        self.units = Units
         self.grid(**layout)
         self.to_grid()
         self.input: InputWidgets = InputWidgets()
@@ -296,6 +301,8 @@ class ParamWidget(ttk.LabelFrame):
         self.opts = Options
         self.bounds = Bounds
         self.increment = Increment
+        self._committed = None  # (Value, Options) as last emitted or loaded; each subclass sets it once built
+        self._debounce = None   # Pending Tk `after` id for the debounced commit
         # Bind the widget area to the tooltip area for displaying descriptions.
         self.bind("<Enter>", self.on_enter)
         self.bind("<Leave>", self.on_leave)
@@ -509,18 +516,96 @@ class ParamWidget(ttk.LabelFrame):
         self.input.StringValue.set(text)
         self.input.String.grid(**layout)
         myDecorations.addEntryStyle()
-        self.bind("<Key>", callback)
+        self.input.String.bind("<KeyRelease>", callback)
+        self.input.String.bind("<FocusOut>", callback)
 
-    # noinspection PyUnusedLocal
-    def handle_emitter(self, event):
-        """Handle changes to the parameter widget."""
-        del event
-        if self.emitter is not None:
-            s = "parameter.updated.{p_type}.{p_name}".format(
-                p_type=self.type.lower(),
-                p_name=self.name
-            )
-            self.emitter.emit(s, self.to_dict())
+    def handle_emitter(self, event: Event = None) -> None:
+        """Handle input events on the parameter widget by (re)starting its debounce timer.
+
+        The value is only emitted once input has stopped for DEBOUNCE_MS (or right away when focus leaves the widget),
+        and only if it differs from the last committed value.
+
+        :param event: The input event (`<Button>`, `<KeyRelease>`, `<<Increment>>`, `<FocusOut>`, etc.)
+        :type event: Event or None
+        :returns: None
+        :rtype: None
+        """
+        if self.emitter is None:
+            return
+        if self._debounce is not None:
+            self.after_cancel(self._debounce)
+            self._debounce = None
+        if event is not None and event.type == EventType.FocusOut:
+            self.commit()
+        else:
+            self._debounce = self.after(DEBOUNCE_MS, self.commit)
+
+    def commit(self) -> None:
+        """Emit `parameter.updated.<type>.<name>` if the value has changed since it was last committed.
+
+        :returns: None
+        :rtype: None
+        """
+        self._debounce = None
+        p = self.to_dict()
+        current = (p['Value'], self.listed(p['Options']))
+        if current == self._committed:
+            return
+        self._committed = current
+        s = "parameter.updated.{p_type}.{p_name}".format(
+            p_type=self.type.lower(),
+            p_name=self.name
+        )
+        self.emitter.emit(s, p)
+
+    def flush(self) -> None:
+        """Commit a pending (debounced) edit right away, e.g. before the widget is reused for another parameter.
+
+        :returns: None
+        :rtype: None
+        """
+        if self._debounce is not None:
+            self.after_cancel(self._debounce)
+            self.commit()
+
+    def rebind(self, Name: str, Description: str = "", **kwargs) -> None:
+        """Reuse this widget for another parameter with the same Type, Units, Bounds and Increment.
+
+        :param Name: Name of the parameter now shown by this widget.
+        :param Description: Description of the parameter for tooltip.
+        :param kwargs: The rest of the parameter dict ('Value', 'Options', etc.)
+        :type Name: str
+        :type Description: str
+        :type kwargs: dict
+        :returns: None
+        :rtype: None
+        """
+        self.name = Name
+        self.desc = Description
+        self._label.configure(text=Name if self.units is None else Name + " (" + self.units + ")")
+        self.opts = kwargs.get('Options')
+        self.value = dict(Name=Name, Description=Description, **kwargs)
+        self.mark_committed()
+
+    def mark_committed(self) -> None:
+        """Take the widget's current value as committed (e.g. after setting it from loaded parameters).
+
+        :returns: None
+        :rtype: None
+        """
+        self._committed = (self.value, self.listed(self.opts))
+
+    def destroy(self) -> None:
+        """Cancel any pending debounced commit before destroying the widget."""
+        if self._debounce is not None:
+            self.after_cancel(self._debounce)
+            self._debounce = None
+        super().destroy()
+
+    @staticmethod
+    def listed(opts: list or tuple or None) -> list or None:
+        """Options as a list (ttk.Combobox reports them as a tuple), so that they compare equal."""
+        return None if opts is None else list(opts)
 
     def to_dict(self) -> ParamJSONFormat:
         """Return value of the parameter as a dict.
@@ -722,6 +807,7 @@ class ParamArray(ParamWidget):
         super().__init__(**args)
         self.to_grid(n_rows=1, n_columns=1)
         self.addTextEntry(text=self.array_2_str(Value))
+        self.mark_committed()
 
     @property
     def value(self) -> list:
@@ -746,7 +832,7 @@ class ParamArray(ParamWidget):
         if v is None:
             self.input.StringValue.set("")
             return
-        elif type(v) is dict:
+        elif isinstance(v, Mapping):  # dict or Parameter
             v = v['Value']
         self.input.StringValue.set(self.array_2_str(v))  # Concatenate the list using ", "
 
@@ -778,6 +864,7 @@ class ParamBoolean(ParamWidget):
         super().__init__(**args)
         self.to_grid(n_rows=1, n_columns=1)
         self.addCheckBox(checked=Value)
+        self.mark_committed()
 
     @property
     def value(self) -> bool:
@@ -795,7 +882,7 @@ class ParamBoolean(ParamWidget):
         """
         if v is None:
             self.input.BoolValue.set(False)
-        elif type(v) is dict:
+        elif isinstance(v, Mapping):  # dict or Parameter
             v = v['Value']
         self.input.BoolValue.set(v)
 
@@ -832,6 +919,7 @@ class ParamDropdown(ParamWidget):
         args = self.to_args(arg_dict=locals(), type_='Dropdown')
         super().__init__(**args)
         self.addDropdown(text=Value, opts=Options)
+        self.mark_committed()
 
     @property
     def opts(self) -> list:
@@ -909,6 +997,7 @@ class ParamDropdownTags(ParamWidget):
         args = self.to_args(locals(), type_="DropdownTags")
         super().__init__(**args)
         self.addDropdown(text=self.list_2_str(Value), opts=Options)
+        self.mark_committed()
 
     @property
     def value(self) -> list:
@@ -965,6 +1054,7 @@ class ParamLabel(ParamWidget):
         super().__init__(**args)
         self.to_grid(n_rows=1, n_columns=1)
         self.addTextEntry(text=Value)
+        self.mark_committed()
 
     @property
     def value(self) -> str:
@@ -1037,6 +1127,7 @@ class ParamObject(ParamWidget):
             # Add the parameter widget to the dictionary of all such widgets.
             self.children[name] = child_widget
             layout['column'] += column_span
+        self.mark_committed()
 
     @property
     def value(self) -> dict:
@@ -1101,6 +1192,7 @@ class ParamScalar(ParamWidget):
         self._type = type(Value)
         self.to_grid(n_rows=1, n_columns=1)
         self.addSpinBox(value=Value)
+        self.mark_committed()
 
     @property
     def value(self) -> float or int:
@@ -1120,7 +1212,7 @@ class ParamScalar(ParamWidget):
         :returns: None
         :rtype: None
         """
-        if type(v) is dict:
+        if isinstance(v, Mapping):  # dict or Parameter
             v = v['Value']
         self._type = type(v)
         self.input.Spin.set(v)
@@ -1162,6 +1254,7 @@ class ParamTags(ParamWidget):
         super().__init__(**args)
         self.to_grid(n_rows=1, n_columns=1)
         self.addTextEntry(text=self.array_2_str(Value))
+        self.mark_committed()
 
     @property
     def value(self) -> list:
@@ -1181,6 +1274,6 @@ class ParamTags(ParamWidget):
         :returns: None
         :rtype: None
         """
-        if type(v) is dict:
+        if isinstance(v, Mapping):  # dict or Parameter
             v = v['Value']
         self.input.StringValue.set(self.list_2_str(v))  # Concatenate the list using ", "
@@ -22,5 +22,7 @@ DEFAULT_LAYOUTS_DIR = path.join(ROOT_DIR, "default_layouts")
 DEFAULT_PARAMETERS_DIR = path.join(ROOT_DIR, "default_parameters")
 DEFAULT_PARAMETERS_FILE = "params_Spencer-MID.json";
 SAVED_PARAMETERS_DIR = path.join(ROOT_DIR, "saved_parameters")
+SERVER_STATE_DIR = path.join(ROOT_DIR, "server_state")
 WEBSOCKET_IP = "128.2.244.29"
-WEBSOCKET_PORT = 6789
\ No newline at end of file
+WEBSOCKET_PORT = 6789
+WEBSOCKET_SESSION = ""  # Parameter server session (websocket path) for this rig, e.g. "rig/3"; "" is the default session
\ No newline at end of file
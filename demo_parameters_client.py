@@ -1,5 +1,8 @@
-import asyncio, json, os, threading, websockets
+import asyncio, itertools, json, os, threading, websockets
+from collections.abc import Mapping
 from enum import Enum
+from component.model import Parameter, next_filename, write_json, write_new_json
+from protocol import SUBPROTOCOLS, decode, encode
 
 PARAMETERS_IP = "128.2.244.29"
 PARAMETERS_PORT = 6789
@@ -197,13 +200,25 @@ class ParamJSONFormat(dict):
         """
         kw = locals()
         kw.pop('self')
+        kw.pop('__class__', None)  # Present in locals() because of the zero-argument super()
         super().__init__(**kw)
         
 
 class GameParameters():
-    def __init__(self, logging = None, parameters=None, session: str = None, ws_ip: str = PARAMETERS_IP, ws_port: int = PARAMETERS_PORT):
-        """Game parameters object."""
-        self._uri = f"ws://{ws_ip}:{ws_port}"
+    def __init__(self, logging = None, parameters=None, session: str = None, ws_ip: str = PARAMETERS_IP, ws_port: int = PARAMETERS_PORT, topics: dict = None, rig: str = ""):
+        """Game parameters object.
+
+        :param topics: (Optional) Only receive updates for these topics, e.g. {"names": ["Trials"], "pages": [...], "tasks": [...]}.
+        :param rig: (Optional) Parameter server session to join, e.g. "rig/3" (default is the server's default session).
+        """
+        self._uri = f"ws://{ws_ip}:{ws_port}/{rig}"
+        self._topics = topics
+        self._revision = None  # Last server revision seen, so reconnects only fetch what was missed.
+        self._epoch = None
+        # Requests in flight on the server connection: request id -> future resolved with the reply.
+        self._requests = {}
+        self._request_ids = itertools.count(1)
+        self._loop = asyncio.new_event_loop()  # Runs the server connection on `_thread`.
         self._thread = threading.Thread(target=self.pthread_target, daemon=True)
         self.logging = logging
         self.ws = None
@@ -252,11 +267,11 @@ class GameParameters():
         
         :param name: Name of the parameter to return.
         :type name: str
-        :returns: Parameter dict for some particular parameter name.
+        :returns: Parameter dict for some particular parameter name (a copy).
         :rtype: dict
         :example: ui._parameters['Subject'] = self >> 'Subject'
         """
-        return self._parameters[name]
+        return dict(self._parameters[name])
     
     def __lshift__(self, par) -> None:
         """Shift 'in' a parameter.
@@ -281,31 +296,39 @@ class GameParameters():
         """Full filenameof layout.json for parameters ui layout."""
         return os.path.join(os.path.abspath(self.paths['layouts']), self._layout_file)
     
-    @property
-    def save_name(self) -> str:
-        """Auto-parsed filename for this session.
+    def session_name(self) -> str:
+        """Auto-parsed name for this session's files, without the index and extension.
 
         .. note::
             See the params.json parameter entry for `Naming Variables`.
             If `Naming Variables` is missing, the following metadata parameters are required:
                 + Task
 
-        .. seealso:: self.loadParameters, self.saveParameters
+        .. seealso:: self.load, self.save
         """
         value = self.formatted_date()
         delimiter = self.filename_delimiter
         if "Naming Variables" in self._parameters.keys():
-            schema = self.get("Naming Variables")
+            schema = self._parameters["Naming Variables"]['Value']
         else:
             schema = ["Task"]
         for k in schema:  # For each element in schema list, add delimited metadata to name
-            value = value + delimiter + self.get(k)
-        file_index = 0
-        file_name = os.path.join(os.path.abspath(self.paths['save']), self.get('Subject'), 'Behavior', value + delimiter + '{0:02d}'.format(file_index) + '.json')
-        while check_for_file(file_name):  # While a file of that name exists, increment the index variable.
-            file_index += 1
-            file_name = os.path.join(os.path.abspath(self.paths['save']), self.get('Subject'), 'Behavior', value + delimiter + '{0:02d}'.format(file_index) + '.json')
-        return file_name
+            value = value + delimiter + str(self._parameters[k]['Value'])
+        return value
+
+    def save_directory(self) -> str:
+        """Folder this session's files are saved in (created by self.save)."""
+        return os.path.join(os.path.abspath(self.paths['save']), self._parameters['Subject']['Value'], 'Behavior')
+
+    @property
+    def save_name(self) -> str:
+        """Auto-parsed filename for this session's next save.
+
+        This is only the next free name in the save folder; self.save claims a name as it writes the file.
+
+        .. seealso:: self.session_name, self.save
+        """
+        return next_filename(self.save_directory(), self.session_name())
     
     @property
     def verbose(self):
@@ -315,8 +338,8 @@ class GameParameters():
             return self._parameters['Verbose Output']['Value']
         
     def as_dict(self) -> dict:
-        """Return parameters as dict."""
-        return self._parameters
+        """Return parameters as dict (a copy, as plain dicts that json can dump)."""
+        return {k: dict(v) for (k, v) in self._parameters.items()}
         
     def debug(self, msg, min_verbosity_level: int = 1):
         """Message logging to terminal."""
@@ -347,49 +370,110 @@ class GameParameters():
     def keys(self):
         return self._parameters.keys()
     
-    async def get(self, name):
-        """Return the value of a specific parameter.
+    async def get(self, name, timeout: float = 5.0):
+        """Return the value of a specific parameter, as currently held by the parameter server.
 
         :param name: The name (key) for a given parameter.
         :type name: str
+        :param timeout: Seconds to wait for the server before raising `asyncio.TimeoutError`.
+        :type timeout: float
         """
-        # if name not in self.keys():
-        #    self.debug("error.parameters.name={name} (Invalid parameter name)".format(name=name), 1)
-        #    return None
-        # else:
-            # print("{name}:{value}".format(name=name, value=self._parameters[name]))
-            # return self._parameters[name]['Value']
-        async with websockets.connect(self._uri) as ws:
-            if name not in self._parameters.keys():
-                self._parameters[name] = {}
-            await ws.send(json.dumps({"type": 'get_parameter', "name": name}))
-            val = json.loads(await ws.recv())
-            while not (val["type"] == "iparam"):
-                val = json.loads(await ws.recv())
-            self._parameters[name]['Value'] = val['value']
-            return self._parameters[name]['Value']
+        reply = await self.request({"type": "get_parameter", "name": name}, timeout)
+        if not reply['has_data']:
+            self.debug("error.parameters.name={name} (Invalid parameter name)".format(name=name), 1)
+            return None
+        self._parameters[name] = Parameter(reply['value'])
+        return self._parameters[name]['Value']
+
+    async def get_many(self, names, timeout: float = 5.0) -> dict:
+        """Return the values of several parameters in one round trip to the parameter server.
+
+        :param names: The names (keys) of the parameters.
+        :type names: list
+        :param timeout: Seconds to wait for the server before raising `asyncio.TimeoutError`.
+        :type timeout: float
+        :return: Name -> value for each of `names` that the server has.
+        """
+        reply = await self.request({"type": "get_parameters", "names": list(names)}, timeout)
+        for name in reply['missing']:
+            self.debug("error.parameters.name={name} (Invalid parameter name)".format(name=name), 1)
+        self._parameters.update({name: Parameter(entry) for (name, entry) in reply['parameters'].items()})
+        return {name: entry['Value'] for (name, entry) in reply['parameters'].items()}
+
+    async def request(self, message: dict, timeout: float = 5.0) -> dict:
+        """Send `message` to the parameter server and return the server's reply to it.
+
+        Requests share the one connection kept by the parameter thread, so any number can be in flight at once
+        (e.g. with `asyncio.gather`), from any event loop.
+
+        :param message: Request, e.g. {"type": "get_parameter", "name": "Trials"}; an `id` is added to it.
+        :type message: dict
+        :param timeout: Seconds to wait for the server before raising `asyncio.TimeoutError`.
+        :type timeout: float
+        """
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(self._request(message), timeout), self._loop)
+        return await asyncio.wrap_future(future)
+
+    async def _request(self, message):
+        # Runs on the parameter thread's loop, which owns the connection and `_requests`.
+        while self.ws is None:
+            await asyncio.sleep(0.05)
+        request_id = next(self._request_ids)
+        reply = self._loop.create_future()
+        self._requests[request_id] = reply
+        try:
+            await self.ws.send(encode({**message, "id": request_id}, self.ws.subprotocol))
+            return await reply
+        finally:
+            self._requests.pop(request_id, None)
             
     async def server_message_handler(self):
-        """Returns the value from the parameter server."""
-        async with websockets.connect(self._uri) as ws:
+        """Keeps parameters in sync with the parameter server until the connection drops."""
+        async with websockets.connect(self._uri, subprotocols=SUBPROTOCOLS) as ws:
             try:
-                await self._server_message_parser(ws)
+                hello = {"type": "hello", "since": self._revision, "epoch": self._epoch}
+                if self._topics is not None:
+                    hello.update(self._topics)
+                await ws.send(encode(hello, ws.subprotocol))
+                self.ws = ws
+                async for message in ws:
+                    self._server_message_parser(decode(message))
             except websockets.ConnectionClosed:
                 await asyncio.sleep(0.1)
+            finally:
+                self.ws = None
+                # Requests sent on this connection will never be answered.
+                for reply in self._requests.values():
+                    if not reply.done():
+                        reply.set_exception(ConnectionError("Parameter server connection closed."))
             
-    async def _server_message_parser(self, ws):
-        data = json.loads(await ws.recv())
-        while not (data["type"] == "parameters"):
-            data = json.loads(await ws.recv())
-        if data['has_data'] == True:
-            p = json.loads(data['parameters'])
-            for (k,v) in p.items():
+    def _server_message_parser(self, data):
+        if data.get('id') in self._requests:
+            reply = self._requests[data['id']]
+            if not reply.done():
+                reply.set_result(data)
+            return
+        # A task change and a patch made together share a revision but arrive as two messages, task first, so only
+        # the parameters messages say everything up to their revision has arrived (see `hello` in server_message_handler).
+        if data["type"] in ("parameters", "parameters_patch"):
+            self._revision = data['revision']
+        if data["type"] == "parameters":
+            self._epoch = data['epoch']
+            if data['has_data'] == True:
+                p = data['parameters']
+                for (k,v) in p.items():
+                    self._parameters[k] = Parameter(v)
+                self.debug("Parameters updated.")
+            else:
+                self.debug("Parameters not yet initialized.")
+        elif data["type"] == "parameters_patch":
+            for (k, fields) in data['patch'].items():
                 if k not in self._parameters.keys():
-                    self._parameters[k] = {}
-                self._parameters[k] = v
-            self.debug("Parameters updated.")
-        else:
-            self.debug("Parameters not yet initialized.")
+                    self._parameters[k] = Parameter()
+                self._parameters[k].update(fields)
+            for k in data['removed']:
+                self._parameters.pop(k, None)
+            self.debug("Parameters patched ({n} changed).".format(n=len(data['patch']) + len(data['removed'])))
         
     def bounds(self, name):
         """Return the bounds of a specific parameter."""
@@ -427,7 +511,7 @@ class GameParameters():
         params = array_form['parameters']
         parameters = {}
         for p in params:
-            parameters[p['Name']] = p
+            parameters[p['Name']] = Parameter(p)
         if 'layout' in array_form.keys():
             layout = array_form['layout']
         else:
@@ -471,10 +555,10 @@ class GameParameters():
     @property 
     def log_file(self) -> str:
         return os.path.join(os.path.abspath(self.paths['trials']),
-                            self.get('Subject'),
+                            self._parameters['Subject']['Value'],
                             'Behavior',
                             '{subject}{delimiter}{session}{delimiter}params-{index}.txt'.format(
-                                subject=self.get('Subject'),
+                                subject=self._parameters['Subject']['Value'],
                                 delimiter=self.filename_delimiter,
                                 session=self.session,
                                 index=self._index))
@@ -495,19 +579,17 @@ class GameParameters():
         data = {}
         for k in self._parameters.keys():
             data[k] = self >> k
-            out['parameters'].append(data[k])
+            out['parameters'].append(dict(data[k]))
         out['icon'] = self._icon_file
         out['layout'] = self._layout_file
         # print(out);
-        with open(self.save_name, 'wt') as f:
-            json.dump(out, f, indent=2)
-            f.close()
+        directory = self.save_directory()
+        os.makedirs(directory, exist_ok=True)
+        write_new_json(directory, self.session_name(), out)
         # Update defaults file for this subject as well.
         updated_default_file = os.path.join(os.path.abspath(self.paths['load']),
-                                            'params_{subj}.json'.format(subj=self.get('Subject')))
-        with open(updated_default_file, 'wt') as ud:
-            json.dump(out, ud, indent=2)
-            ud.close()
+                                            'params_{subj}.json'.format(subj=self._parameters['Subject']['Value']))
+        write_json(updated_default_file, out)
         return True        
     
     def setPageIndex(self, name: str, index: int) -> None:
@@ -517,7 +599,7 @@ class GameParameters():
     def update(self, parameters) -> None:
         """Update a specific parameter value."""
         for name, value in parameters.items():
-            if type(value) in (dict, object):
+            if isinstance(value, Mapping):  # dict or Parameter
                 formatted_name = name.replace(' ', '_')
                 self.debug("data.parameters.{name}={value}".format(name=formatted_name, value=value['Value']), 1)
                 self._parameters[name]['Value'] = value['Value']
@@ -535,13 +617,16 @@ class GameParameters():
                 self.debug("data.parameters.{name}={value}".format(name=formatted_name, value=value), 1)
 
     def pthread_target(self):
-        asyncio.run(self.parameter_thread())
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self.parameter_thread())
                                         
     async def parameter_thread(self):
         print("GameParameters initialized!")
         while True:
-            await self.server_message_handler()
-            print(self.as_dict())
+            try:
+                await self.server_message_handler()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):  # Server not reachable yet; try again shortly.
+                await asyncio.sleep(1.0)
  
 async def main():
     parameters = GameParameters()
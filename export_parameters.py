@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Export session parameters files without the interface (no display needed).
+
+Loads one or more parameters files, applies the same changes to each, and writes one auto-named session file per
+input file and patch, named like the interface's `Save` button does (date, `Naming Variables`, index).
+
+Usage:
+    python export_parameters.py params_Spencer-MID.json --set Subject=Rupert --set "Task=VMR" -o saved_parameters
+    python export_parameters.py default_parameters/*.json --patch sessions.json
+
+`--set NAME=VALUE` sets the Value of a parameter (VALUE is read as JSON if it parses, else as a string). `--patch`
+takes a JSON file with one patch or a list of patches, each {Name: {field: value}} as in the parameter server's
+`patch_parameters`; every patch in the list gives its own session file.
+"""
+import argparse
+import json
+import os
+import sys
+from component.model import ParameterModel
+from definitions import DEFAULT_PARAMETERS_DIR, SAVED_PARAMETERS_DIR
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_set(text):
+    name, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, got {0!r}".format(text))
+    return name, parse_value(value)
+
+
+def find_file(file_name):
+    """Parameters file by path, or by name in default_parameters/."""
+    if not os.path.exists(file_name) and os.path.exists(os.path.join(DEFAULT_PARAMETERS_DIR, file_name)):
+        return os.path.join(DEFAULT_PARAMETERS_DIR, file_name)
+    return file_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export session parameters files without the interface.")
+    parser.add_argument("files", nargs="+", help="Parameters files (path, or name of a file in default_parameters/).")
+    parser.add_argument("-o", "--output-dir", default=SAVED_PARAMETERS_DIR, help="Folder to write the session files to.")
+    parser.add_argument("--set", dest="values", type=parse_set, action="append", default=[], metavar="NAME=VALUE",
+                        help="Set the Value of a parameter (repeatable).")
+    parser.add_argument("--patch", help="JSON file with a patch, or a list of patches (one session file each).")
+    parser.add_argument("--all-tasks", action="store_true",
+                        help="Keep the parameters of every task (default: only those of the file's Task, like Save).")
+    args = parser.parse_args()
+
+    patches = [{}]
+    if args.patch is not None:
+        with open(args.patch, 'rt') as f:
+            patches = json.load(f)
+        if isinstance(patches, dict):
+            patches = [patches]
+    common = {name: {"Value": value} for (name, value) in args.values}
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for file_name in args.files:
+        base = ParameterModel.load(find_file(file_name))
+        for patch in patches:
+            unknown = [name for name in list(common) + list(patch) if name not in base.parameters]
+            if unknown:
+                parser.error("{0}: no parameter named {1}".format(file_name, ", ".join(map(repr, unknown))))
+            model = base.copy()
+            model.patch(common)
+            model.patch(patch)
+            print(model.save_new(args.output_dir, task=None if args.all_tasks else model.task))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Wire format of parameter server messages.
+
+Clients pick an encoding by offering websocket subprotocols when they connect:
+    * "parameters.json" (also used when no subprotocol is offered, e.g. docs/index.html): JSON text frames. For
+      compatibility, the "parameters" of `parameters`/`set_parameters` and the "value" of `iparam` are themselves
+      JSON strings nested inside the message.
+    * "parameters.msgpack": MessagePack binary frames with nothing nested. Only offered if `msgpack` is installed.
+
+Messages are plain dicts on both sides; `encode` and `decode` take care of the nesting.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = "parameters.json"
+MSGPACK = "parameters.msgpack"
+# In order of preference.
+SUBPROTOCOLS = [JSON] if msgpack is None else [MSGPACK, JSON]
+# Message type -> field that the JSON format carries as a nested JSON string.
+NESTED_FIELDS = {"parameters": "parameters", "set_parameters": "parameters", "iparam": "value"}
+
+
+def encode(message: dict, subprotocol: str = None):
+    """Encode one message for a connection that negotiated `subprotocol` (None means JSON).
+
+    :param message: The message, with any parameters as a dict (not a JSON string).
+    :type message: dict
+    :param subprotocol: Subprotocol of the connection, i.e. `websocket.subprotocol`.
+    :type subprotocol: str
+    :return: Text frame (JSON) or binary frame (MessagePack).
+    """
+    if subprotocol == MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    field = NESTED_FIELDS.get(message.get("type"))
+    if field is not None and not isinstance(message.get(field, ""), str):
+        message = {**message, field: json.dumps(message[field])}
+    return json.dumps(message)
+
+
+def decode(frame) -> dict:
+    """Decode one received frame (binary frames are MessagePack, text frames are JSON).
+
+    :param frame: Frame as returned by `websocket.recv()`.
+    :type frame: str or bytes
+    :return: The message, with any nested JSON already unpacked into a dict.
+    """
+    if isinstance(frame, bytes):
+        return msgpack.unpackb(frame, raw=False)
+    message = json.loads(frame)
+    field = NESTED_FIELDS.get(message.get("type"))
+    if field is not None and isinstance(message.get(field), str) and message[field]:
+        message[field] = json.loads(message[field])
+    return message
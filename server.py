@@ -1,99 +1,1043 @@
 #!/usr/bin/env python
 
-# WS server example that synchronizes state across clients
+# WS server example that synchronizes state across clients.
+#
+# Each websocket path is its own session with independent state, e.g. ws://host:port/rig/3 and ws://host:port/rig/4
+# (the bare ws://host:port/ is the default session). With --workers N, sessions are spread over N worker processes
+# behind the one listening port; every connection to a given session always lands on the same worker.
+#
+# Clients may negotiate a binary (MessagePack) encoding through the websocket subprotocol; see protocol.py.
+#
+# A plain HTTP GET of /metrics (on the same port) returns server metrics in the Prometheus text format.
 
+import argparse
 import asyncio
 import json
 import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import uuid
 import websockets
-from definitions import WEBSOCKET_IP, WEBSOCKET_PORT
+import zlib
+from bisect import bisect_left
+from collections import Counter, deque
+from http import HTTPStatus
+from urllib.parse import quote
+from definitions import SERVER_STATE_DIR, WEBSOCKET_IP, WEBSOCKET_PORT
+from protocol import JSON, SUBPROTOCOLS, decode, encode
 
 logging.basicConfig()
 
-STATE = {"task": None, 
-         "parameters": None}
+HISTORY_LENGTH = 1024       # Recent changes each session keeps for resuming clients
+HELLO_WAIT = 0.2            # Seconds a new connection has to send `hello` before it is sent a full snapshot
+SEND_QUEUE_LIMIT = 64       # Outbound messages a client may have queued before its state messages collapse into one snapshot
+THREADED_ENCODE_SIZE = 64   # Snapshots of more parameters than this are encoded on a worker thread
+SNAPSHOT_INTERVAL = 256     # Logged changes after which a session's state is compacted into a fresh snapshot file
+SLOW_RTT = 0.5              # Seconds of ping round trip above which a client is reported as "slow"
 
-USERS = set()
+# Topic kinds match the parameter fields they are keyed on ("names" -> Name, "pages" -> Page, "tasks" -> Task).
+TOPIC_KINDS = ("names", "pages", "tasks")
+# Client message types the server understands (anything else is counted as "unknown" in the metrics).
+REQUEST_TYPES = ("set_parameters", "patch_parameters", "set_task", "hello", "subscribe", "unsubscribe",
+                 "get_parameter", "get_parameters")
+METRICS_PATH = "/metrics"
+# Parameter fields that define what values are valid; validators are rebuilt only when one of these changes.
+SCHEMA_FIELDS = ("Type", "Bounds", "Options")
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # seconds
+LOOP_LAG_INTERVAL = 0.1     # Seconds between event-loop lag samples
 
-def parameters_event():
-    if STATE['parameters'] is None:
-        p = json.dumps({"type": "parameters", "has_data": False, "parameters": ""})
-    else:
-        p = json.dumps({"type": "parameters", "has_data": True, "parameters": json.dumps(STATE['parameters'])})
-    return p
+SESSIONS = {}  # session name -> Session
+# Runtime settings (set from the command line):
+#   state_dir: where sessions persist their state (None keeps everything in memory).
+#   coalesce_window: seconds during which changes are merged into one revision and one broadcast (0 disables).
+#   ping_interval: seconds between heartbeat pings to every client (0 disables the heartbeat).
+#   ping_timeout: seconds a client has to answer a ping before it is dropped.
+#   send_timeout: seconds a single send to a client may take before the client is dropped.
+CONFIG = {"state_dir": SERVER_STATE_DIR,
+          "coalesce_window": 0.01,
+          "ping_interval": 5.0,
+          "ping_timeout": 10.0,
+          "send_timeout": 10.0}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense: counts of observations at or below each bound."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ("+Inf", ), self.counts):
+            total += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, bound, total))
+        lines.append("{0}_sum {1}".format(name, self.sum))
+        lines.append("{0}_count {1}".format(name, total))
+        return lines
+
+
+class Metrics:
+    """Counters and histograms for the /metrics endpoint; gauges are read from SESSIONS when scraped."""
+    def __init__(self):
+        self.received = Counter()    # message type -> messages received
+        self.sent = Counter()        # message type -> messages sent
+        self.bytes_sent = 0
+        self.fanout_latency = Histogram()   # Queued for a client -> written to its socket
+        self.loop_lag = Histogram()         # How late the event loop wakes up from a LOOP_LAG_INTERVAL sleep
+
+    def message_received(self, kind):
+        self.received[kind if kind in REQUEST_TYPES else "unknown"] += 1
+
+    def message_sent(self, kind, size, latency):
+        self.sent[kind] += 1
+        self.bytes_sent += size
+        self.fanout_latency.observe(latency)
+
+    async def watch_event_loop(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+    def render(self):
+        """Current metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP {0} {1}".format(name, description))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+
+        family("parameter_server_users", "gauge", "Connected clients per session.")
+        for name, session in SESSIONS.items():
+            lines.append('parameter_server_users{{session="{0}"}} {1}'.format(label(name), len(session.users)))
+        family("parameter_server_revision", "gauge", "Current state revision per session.")
+        for name, session in SESSIONS.items():
+            lines.append('parameter_server_revision{{session="{0}"}} {1}'.format(label(name), session.state["revision"]))
+        family("parameter_server_messages_received_total", "counter", "Client messages received, by type.")
+        for kind, count in sorted(self.received.items()):
+            lines.append('parameter_server_messages_received_total{{type="{0}"}} {1}'.format(kind, count))
+        family("parameter_server_messages_sent_total", "counter", "Messages sent to clients, by type.")
+        for kind, count in sorted(self.sent.items()):
+            lines.append('parameter_server_messages_sent_total{{type="{0}"}} {1}'.format(kind, count))
+        family("parameter_server_bytes_sent_total", "counter", "Payload bytes sent to clients.")
+        lines.append("parameter_server_bytes_sent_total {0}".format(self.bytes_sent))
+        family("parameter_server_send_queue_depth", "gauge", "Messages waiting in each client's send queue.")
+        for name, session in SESSIONS.items():
+            for client in session.users.values():
+                lines.append('parameter_server_send_queue_depth{{session="{0}",client="{1}"}} {2}'.format(
+                    label(name), label(client.address), len(client.pending)))
+        family("parameter_server_fanout_latency_seconds", "histogram",
+               "Time from a message being queued for a client to it being written to the client's socket.")
+        lines.extend(self.fanout_latency.render("parameter_server_fanout_latency_seconds"))
+        family("parameter_server_event_loop_lag_seconds", "histogram",
+               "How late the event loop wakes up from a {0} s sleep.".format(LOOP_LAG_INTERVAL))
+        lines.extend(self.loop_lag.render("parameter_server_event_loop_lag_seconds"))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class Client:
+    """Outbound side of one connection: a bounded queue drained by its own writer task.
+
+    State messages are queued under a `slot`. A newer "parameters", "task" or "users" message replaces any queued
+    message in the same slot (a snapshot also replaces queued patches), so a slow client only ever catches up to the
+    latest state instead of replaying every intermediate one. Replies (slot None) are never dropped.
+
+    A client that takes longer than `send_timeout` to accept a message, or `ping_timeout` to answer a heartbeat ping,
+    is dropped, so a peer that vanished without closing its socket cannot hold on to its session slot.
+    """
+    def __init__(self, websocket, session):
+        self.websocket = websocket
+        self.session = session
+        self.subprotocol = websocket.subprotocol or JSON  # Encoding this client negotiated
+        self.address = "{0}:{1}".format(*websocket.remote_address[:2]) if websocket.remote_address else "?"
+        self.pending = deque()  # (slot, message, message type, time queued)
+        self.resync = False     # True when queued state was dropped and a fresh snapshot must go out first
+        self.rtt = None         # Round trip of the last answered heartbeat ping, in seconds
+        self._ready = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._drain())
+
+    def push(self, message, slot=None, kind=None):
+        """Queue an encoded message (of type `kind`, for the metrics) without waiting for it to be sent."""
+        if slot in ("parameters", "task", "users"):
+            stale = ("parameters", "patch") if slot == "parameters" else (slot, )
+            self.pending = deque(m for m in self.pending if m[0] not in stale)
+            if slot == "parameters":
+                self.resync = False
+        self.pending.append((slot, message, kind or slot, time.monotonic()))
+        if len(self.pending) > SEND_QUEUE_LIMIT:
+            self.pending = deque(m for m in self.pending if m[0] not in ("parameters", "patch"))
+            self.resync = True
+        self._ready.set()
+
+    def close(self):
+        self._writer.cancel()
+
+    def status(self):
+        """Connection health as reported in the users event: "ok", "slow" (high ping) or "behind" (dropped state)."""
+        if self.resync:
+            return "behind"
+        if self.rtt is not None and self.rtt > SLOW_RTT:
+            return "slow"
+        return "ok"
+
+    def health(self):
+        return {"address": self.address, "status": self.status(),
+                "rtt_ms": None if self.rtt is None else round(self.rtt * 1000, 1), "queued": len(self.pending)}
+
+    async def ping(self):
+        """Ping the peer and record the round trip, dropping the client if it does not answer within ping_timeout."""
+        start = time.monotonic()
+        try:
+            # Sending the ping itself can block on a dead peer, so the timeout covers both.
+            await asyncio.wait_for(self._ping(), CONFIG["ping_timeout"])
+        except asyncio.TimeoutError:
+            await self.drop("ping timeout")
+        except websockets.ConnectionClosed:
+            pass
+        else:
+            self.rtt = time.monotonic() - start
+
+    async def _ping(self):
+        await (await self.websocket.ping())
+
+    async def drop(self, reason):
+        """Fail the connection right away (without waiting on the peer) and take the client out of its session."""
+        print("Dropping client {0} ({1}).".format(self.address, reason))
+        self.websocket.fail_connection(1011, reason)
+        await self.session.unregister(self.websocket)
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            if self.resync:
+                self.resync = False
+                kind, queued = "parameters", time.monotonic()
+                message = await self.session.snapshot_message(self.session.subscribed_names(self.websocket),
+                                                              self.subprotocol)
+            elif self.pending:
+                _, message, kind, queued = self.pending.popleft()
+            else:
+                self._ready.clear()
+                continue
+            try:
+                await asyncio.wait_for(self.websocket.send(message), CONFIG["send_timeout"])
+            except asyncio.TimeoutError:
+                asyncio.ensure_future(self.drop("send timeout"))  # drop() cancels this task, so it can't await it.
+                return
+            except websockets.ConnectionClosed:
+                return
+            METRICS.message_sent(kind, len(message), time.monotonic() - queued)
+
+
+class StateLog:
+    """Append-only change log plus periodic snapshot that lets a session survive a server restart.
+
+    Changes are queued by the event loop and written (and fsync'd) by a background task on a worker thread, so the
+    loop never waits on the disk. Every SNAPSHOT_INTERVAL changes the whole state is written to a new snapshot file
+    (atomically, via rename) and the log is truncated, so a restart only ever replays a short tail.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot_file = os.path.join(directory, "snapshot.json")
+        self.log_file = os.path.join(directory, "changes.log")
+        self._queue = None
+        self._writer = None
+        self._since_snapshot = 0
+
+    def load(self):
+        """Return (state, tail) from disk: the snapshot state (or None) and the logged changes made after it."""
+        state = None
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'rt') as f:
+                state = json.load(f)
+        revision = 0 if state is None else state["revision"]
+        tail = []
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'rt') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:  # The last line may be cut short if the server died mid-write.
+                        break
+                    if change["revision"] > revision:
+                        tail.append(change)
+        self._since_snapshot = len(tail)
+        return state, tail
+
+    def append(self, change, session):
+        """Queue one change record for writing (never blocks)."""
+        if self._writer is None:
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.ensure_future(self._write_forever(session))
+        self._queue.put_nowait(change)
+
+    async def _write_forever(self, session):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            changes = [await self._queue.get()]
+            while not self._queue.empty():
+                changes.append(self._queue.get_nowait())
+            await asyncio.to_thread(self._write_changes, changes)
+            self._since_snapshot += len(changes)
+            if self._since_snapshot >= SNAPSHOT_INTERVAL:
+                # Everything written so far is at or below the revision of this copy, so the log can start over.
+                state = dict(session.state)
+                if state["parameters"] is not None:
+                    state["parameters"] = dict(state["parameters"])
+                await asyncio.to_thread(self._write_snapshot, state)
+                self._since_snapshot = 0
+
+    def _write_changes(self, changes):
+        with open(self.log_file, 'at') as f:
+            for change in changes:
+                f.write(json.dumps(change) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, state):
+        tmp = self.snapshot_file + ".tmp"
+        with open(tmp, 'wt') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_file)
+        # Changes logged from here on are newer than the snapshot; older ones are skipped on load anyway.
+        open(self.log_file, 'wt').close()
+
+
+class Session:
+    """Task and parameters shared by every client connected to one websocket path."""
+    def __init__(self, name, log=None):
+        self.name = name
+        self.log = log
+        # `revision` goes up by one on every change to `task` or `parameters`; encoded messages are cached against it.
+        # `epoch` identifies this run of the session, so clients can tell whether their last-seen revision still applies.
+        self.state = {"task": None,
+                      "parameters": None,
+                      "revision": 0,
+                      "epoch": uuid.uuid4().hex}
+        # Ring buffer of recent changes as (revision, patch, removed, task), where `removed` maps each removed Name to
+        # its last entry (so resuming subscribers can be matched by Page and Task); `None` task means it did not change.
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self.users = {}  # websocket -> Client
+        # Topic subscriptions: each topic kind maps a topic value to the set of sockets subscribed to it.
+        self.subscriptions = {kind: {} for kind in TOPIC_KINDS}
+        self.subscribed = {}      # websocket -> {topic kind: set of topic values} for sockets that subscribed to anything
+        self.unfiltered = set()   # sockets without any subscription still receive every update
+        self.validators = {}      # Name -> function checking a new Value (see compile_validator)
+        self._heartbeat = None
+        # Messages for the current revision, keyed by message kind (and subprotocol and parameter subset, for snapshots).
+        self._cache = {"revision": None, "messages": {}}
+        # Changes already applied to `state` but not yet given a revision or broadcast (see `commit`).
+        self._pending = new_pending()
+        self._flush = None
+        if self.log is not None:
+            self.restore()
+
+    def restore(self):
+        """Rebuild the state (and recent history) from the session's snapshot and the changes logged after it."""
+        state, tail = self.log.load()
+        if state is not None:
+            self.state = state
+        for change in tail:
+            if change["patch"] or change["removed"]:
+                parameters = self.state["parameters"]
+                if parameters is None:
+                    parameters = self.state["parameters"] = {}
+                for name, fields in change["patch"].items():
+                    parameters[name] = {**parameters.get(name, {}), **fields}
+                removed = {name: parameters.pop(name, None) for name in change["removed"]}
+            else:
+                removed = {}
+            if change["task"] is not None:
+                self.state["task"] = change["task"]
+            self.state["revision"] = change["revision"]
+            self.state["epoch"] = change["epoch"]
+            self.history.append((change["revision"], change["patch"], removed, change["task"]))
+        if state is None and not tail:
+            return
+        self.validators = {name: compile_validator(entry) for (name, entry) in (self.state["parameters"] or {}).items()}
+        print("Restored session '{0}' at revision {1}.".format(self.name, self.state["revision"]))
+
+    def cached_messages(self):
+        """Message cache for the current revision (emptied whenever the revision moves on)."""
+        if self._cache["revision"] != self.state["revision"]:
+            self._cache["revision"] = self.state["revision"]
+            self._cache["messages"] = {}
+        return self._cache["messages"]
+
+    async def snapshot_message(self, names=None, subprotocol=JSON):
+        """Parameters snapshot (optionally only `names`), encoded at most once per revision and subprotocol."""
+        messages = self.cached_messages()
+        key = ("parameters", subprotocol, None if names is None else frozenset(names))
+        if key not in messages:
+            parameters = self.state["parameters"]
+            if parameters is not None:
+                # Entries are replaced rather than mutated (see apply_patch), so a shallow copy is a stable snapshot.
+                parameters = dict(parameters) if names is None else {k: v for (k, v) in parameters.items() if k in names}
+            revision, epoch = self.state["revision"], self.state["epoch"]
+            if parameters is not None and len(parameters) > THREADED_ENCODE_SIZE:
+                # Cache the pending encode itself so concurrent requests for the same snapshot share one thread job.
+                messages[key] = asyncio.ensure_future(
+                    asyncio.to_thread(encode, parameters_event(parameters, revision, epoch), subprotocol))
+            else:
+                messages[key] = encode(parameters_event(parameters, revision, epoch), subprotocol)
+        message = messages[key]
+        if isinstance(message, asyncio.Future):
+            message = await message
+        return message
+
+    def specific_parameter_event(self, name):
+        if self.state['parameters'] is None or name not in self.state['parameters']:
+            p = {"type": "iparam", "has_data": False, "value": ""}
+        else:
+            p = {"type": "iparam", "has_data": True, "value": self.state['parameters'][name]}
+        return p
+
+    def parameters_reply_event(self, names):
+        # Reply to `get_parameters`: the requested entries that exist, plus the names that don't.
+        parameters = self.state['parameters'] or {}
+        return {"type": "iparams",
+                "parameters": {name: parameters[name] for name in names if name in parameters},
+                "missing": [name for name in names if name not in parameters]}
+
+    def parameters_patch_event(self, patch, removed=()):
+        return parameters_patch_event(patch, removed, self.state["revision"])
+
+    def task_event(self):
+        messages = self.cached_messages()
+        if "task" not in messages:
+            messages["task"] = task_event(self.state["task"], self.state["revision"])
+        return messages["task"]
+
+    def users_event(self):
+        return {"type": "users", "count": len(self.users), "clients": [c.health() for c in self.users.values()]}
+
+    def validate(self, patch):
+        """Split a Name -> fields patch into (the valid part, Name -> reason for each rejected update).
+
+        Only new Values of existing parameters are checked; new parameters are taken as given, since they define the
+        schema (and the parameter files do contain a few values outside their own Bounds).
+        """
+        parameters = self.state["parameters"] or {}
+        valid, invalid = {}, {}
+        for name, fields in patch.items():
+            if "Value" in fields and name in parameters:
+                validator = self.validators[name]
+                if any(k in fields for k in SCHEMA_FIELDS):
+                    validator = compile_validator({**parameters[name], **fields})
+                error = validator(fields["Value"])
+                if error is not None:
+                    invalid[name] = error
+                    continue
+            valid[name] = fields
+        return valid, invalid
+
+    def apply_patch(self, patch, removed=()):
+        """Merge a Name -> fields patch into the state in place and return only what actually changed."""
+        if self.state["parameters"] is None:
+            self.state["parameters"] = {}
+        parameters = self.state["parameters"]
+        changed = {}
+        for name, fields in patch.items():
+            previous = parameters.get(name)
+            if previous is None:
+                parameters[name] = dict(fields)
+                changed[name] = fields
+                self.validators[name] = compile_validator(parameters[name])
+                continue
+            fields = {k: v for (k, v) in fields.items() if k not in previous or previous[k] != v}
+            if fields:
+                # Swap in a new entry rather than mutating the old one so readers never see it half-updated.
+                parameters[name] = {**previous, **fields}
+                changed[name] = fields
+                if any(k in fields for k in SCHEMA_FIELDS):
+                    self.validators[name] = compile_validator(parameters[name])
+        dropped = {name: parameters.pop(name) for name in removed if name in parameters}
+        for name in dropped:
+            del self.validators[name]
+        pending = self._pending
+        for name, fields in changed.items():
+            pending["removed"].pop(name, None)
+            pending["patch"].setdefault(name, {}).update(fields)
+        for name, entry in dropped.items():
+            pending["patch"].pop(name, None)
+            pending["removed"][name] = entry
+        return changed, dropped
+
+    def set_task(self, task):
+        """Set the current task, returning True if it changed."""
+        if task == self.state["task"]:
+            return False
+        self.state["task"] = task
+        self._pending["task"] = task
+        return True
 
-def specific_parameter_event(name):
-    if STATE['parameters'] is None:
-        p = json.dumps({"type": "iparam", "has_data": False, "value": ""})
+    async def commit(self):
+        """Publish pending changes: right away, or once the coalescing window closes if one is configured.
+
+        Everything that arrives within the window (e.g. spinbox auto-repeat) goes out as one revision and one broadcast.
+        """
+        if CONFIG["coalesce_window"] <= 0:
+            await self.flush()
+        elif self._flush is None:
+            self._flush = asyncio.ensure_future(self._flush_after(CONFIG["coalesce_window"]))
+
+    async def _flush_after(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        await self.flush()
+
+    async def flush(self):
+        """Stamp all pending changes with one revision and broadcast them."""
+        pending, self._pending = self._pending, new_pending()
+        if not (pending["patch"] or pending["removed"] or pending["task"] is not None):
+            return
+        self.record_change(pending["patch"], pending["removed"], pending["task"])
+        if pending["task"] is not None:
+            await self.notify_task()
+        if pending["snapshot"]:
+            await self.notify_parameters()
+        else:
+            await self.notify_parameters_patch(pending["patch"], pending["removed"])
+
+    def record_change(self, patch=None, removed=None, task=None):
+        """Stamp a state mutation with the next revision and remember it for resuming clients.
+
+        `removed` maps each removed Name to its last entry; only the names go to the log.
+        """
+        removed = removed or {}
+        self.state["revision"] += 1
+        self.history.append((self.state["revision"], patch or {}, removed, task))
+        if self.log is not None:
+            self.log.append({"revision": self.state["revision"], "patch": patch or {}, "removed": list(removed),
+                             "task": task, "epoch": self.state["epoch"]}, self)
+
+    def changes_since(self, revision):
+        """Merge every change after `revision` into one (patch, removed, task) triple, or None if it has aged out.
+
+        `removed` maps each removed Name to its last entry (None if it was removed before the last restart and the
+        session had no record of it).
+        """
+        if revision > self.state["revision"]:
+            return None
+        if revision < self.state["revision"] and (not self.history or self.history[0][0] > revision + 1):
+            return None
+        patch, removed, task = {}, {}, None
+        for (r, p, dropped, t) in self.history:
+            if r <= revision:
+                continue
+            for name, fields in p.items():
+                removed.pop(name, None)
+                patch.setdefault(name, {}).update(fields)
+            for name, entry in dropped.items():
+                patch.pop(name, None)
+                removed[name] = entry
+            if t is not None:
+                task = t
+        return patch, removed, task
+
+    def subscribe(self, websocket, topics):
+        """Add `topics` ({"names": [...], "pages": [...], "tasks": [...]}) to the subscriptions of a socket."""
+        mine = self.subscribed.setdefault(websocket, {kind: set() for kind in TOPIC_KINDS})
+        for kind, index in self.subscriptions.items():
+            for topic in topics.get(kind, ()):
+                index.setdefault(topic, set()).add(websocket)
+                mine[kind].add(topic)
+        if any(mine.values()):
+            self.unfiltered.discard(websocket)
+        else:
+            self.subscribed.pop(websocket)
+
+    def unsubscribe(self, websocket, topics=None):
+        """Drop `topics` (or every subscription, if `topics` is None) for a socket."""
+        mine = self.subscribed.get(websocket)
+        if mine is None:
+            return
+        for kind, index in self.subscriptions.items():
+            values = list(mine[kind]) if topics is None else topics.get(kind, ())
+            for topic in values:
+                sockets = index.get(topic)
+                if sockets is not None:
+                    sockets.discard(websocket)
+                    if not sockets:
+                        del index[topic]
+                mine[kind].discard(topic)
+        if not any(mine.values()):
+            self.subscribed.pop(websocket)
+            if websocket in self.users:
+                self.unfiltered.add(websocket)
+
+    def subscribers(self, name, entry):
+        """Sockets subscribed to parameter `name` by its Name, Page or any of its Task values."""
+        sockets = set(self.subscriptions["names"].get(name, ()))
+        if entry is not None:
+            sockets.update(self.subscriptions["pages"].get(entry.get("Page"), ()))
+            for task in entry.get("Task", ()):
+                sockets.update(self.subscriptions["tasks"].get(task, ()))
+        return sockets
+
+    def subscribed_names(self, websocket):
+        """Names of the current parameters a socket is interested in (None if it has not subscribed to anything)."""
+        if websocket not in self.subscribed:
+            return None
+        if self.state["parameters"] is None:
+            return set()
+        return {name for (name, entry) in self.state["parameters"].items()
+                if websocket in self.subscribers(name, entry)}
+
+    def broadcast(self, users, message, slot=None):
+        """Queue `message` for each of `users` (websockets), encoding it once per subprotocol in use."""
+        frames = {}
+        for user in users:
+            client = self.users[user]
+            if client.subprotocol not in frames:
+                frames[client.subprotocol] = encode(message, client.subprotocol)
+            client.push(frames[client.subprotocol], slot, message["type"])
+
+    async def notify_parameters(self):
+        # A large snapshot is encoded on a thread, and clients may come and go while that is awaited.
+        for user, client in list(self.users.items()):
+            message = await self.snapshot_message(self.subscribed_names(user), client.subprotocol)
+            if user in self.users:
+                client.push(message, "parameters", "parameters")
+
+    async def notify_parameters_patch(self, patch, removed=None):
+        if not (patch or removed):
+            return
+        if removed is None:
+            removed = {}
+        if self.unfiltered:
+            self.broadcast(self.unfiltered, self.parameters_patch_event(patch, removed), "patch")
+        if self.subscribed:
+            # Work out which part of the patch each subscriber cares about, then encode once per distinct part.
+            routes = {}
+            for name in patch:
+                for user in self.subscribers(name, self.state["parameters"].get(name)):
+                    routes.setdefault(user, ([], []))[0].append(name)
+            for (name, entry) in removed.items():
+                for user in self.subscribers(name, entry):
+                    routes.setdefault(user, ([], []))[1].append(name)
+            groups = {}
+            for user, (names, dropped) in routes.items():
+                groups.setdefault((tuple(names), tuple(dropped)), []).append(user)
+            for (names, dropped), users in groups.items():
+                self.broadcast(users, self.parameters_patch_event({k: patch[k] for k in names}, dropped), "patch")
+
+    async def notify_task(self):
+        self.broadcast(self.users, self.task_event(), "task")
+
+    async def notify_users(self):
+        self.broadcast(self.users, self.users_event(), "users")
+
+    def reply(self, websocket, request, message):
+        """Send `message` to the one socket that made `request`, tagged with the request's `id` (if it had one)."""
+        if "id" in request:
+            message["id"] = request["id"]
+        self.broadcast((websocket, ), message)
+
+    async def register(self, websocket):
+        self.users[websocket] = Client(websocket, self)
+        self.unfiltered.add(websocket)
+        if self._heartbeat is None and CONFIG["ping_interval"] > 0:
+            self._heartbeat = asyncio.ensure_future(self.heartbeat())
+        await self.notify_users()
+
+    async def heartbeat(self):
+        """Ping every client each ping_interval while anyone is connected; tell everyone when a client's health changes."""
+        try:
+            while self.users:
+                await asyncio.sleep(CONFIG["ping_interval"])
+                clients = list(self.users.values())
+                before = [c.status() for c in clients]
+                await asyncio.gather(*(c.ping() for c in clients))
+                # Dropped clients already triggered a users event of their own.
+                if any(c.status() != b for (c, b) in zip(clients, before) if c.websocket in self.users):
+                    await self.notify_users()
+        finally:
+            self._heartbeat = None
+
+    async def send_snapshot(self, websocket):
+        """Send the full current state to one client."""
+        client = self.users[websocket]
+        self.broadcast((websocket, ), self.task_event(), "task")
+        message = await self.snapshot_message(self.subscribed_names(websocket), client.subprotocol)
+        if websocket in self.users:  # It may have left while a large snapshot was encoded.
+            client.push(message, "parameters", "parameters")
+
+    async def resume(self, websocket, data):
+        """Answer `hello`: send only what changed after revision `since`, or a snapshot if that is not possible."""
+        topics = {kind: data[kind] for kind in TOPIC_KINDS if kind in data}
+        if topics:
+            self.subscribe(websocket, topics)
+        since = data.get("since")
+        delta = None
+        if since is not None and data.get("epoch") == self.state["epoch"]:
+            delta = self.changes_since(since)
+        if delta is None:
+            await self.send_snapshot(websocket)
+            return
+        patch, removed, task = delta
+        if task is not None:
+            self.broadcast((websocket, ), self.task_event(), "task")
+        if websocket in self.subscribed:
+            parameters = self.state["parameters"] or {}
+            patch = {k: v for (k, v) in patch.items() if websocket in self.subscribers(k, parameters.get(k))}
+            removed = [k for (k, entry) in removed.items() if websocket in self.subscribers(k, entry)]
+        # Always answer, even with an empty patch, so the client learns the current revision.
+        self.broadcast((websocket, ), self.parameters_patch_event(patch, removed), "patch")
+
+    async def unregister(self, websocket):
+        if websocket not in self.users:  # Already dropped by the heartbeat or a send timeout
+            return
+        self.users.pop(websocket).close()
+        self.unfiltered.discard(websocket)
+        self.unsubscribe(websocket)
+        await self.notify_users()
+
+    async def handle_message(self, websocket, data):
+        """Act on one client message. Requests carrying an `id` always get exactly one reply with that `id`."""
+        invalid = None
+        if data["type"] in ("set_parameters", "patch_parameters"):
+            parameters = data["parameters"] if data["type"] == "set_parameters" else data["patch"]
+            if not isinstance(parameters, dict):
+                self.reply(websocket, data, {"type": "error", "error": "Expected an object of Name -> fields"})
+                return
+            parameters, malformed = split_malformed(parameters)
+        if data["type"] == "set_parameters":
+            if self.state["parameters"] is None:
+                # The first parameters a session sees go out as a snapshot rather than a patch.
+                if parameters:
+                    self._pending["snapshot"] = True
+                    self.apply_patch(parameters)
+                invalid = malformed
+            else:
+                patch, removed = diff_parameters(self.state["parameters"], parameters)
+                patch, invalid = self.validate(patch)
+                # A malformed entry is not a request to delete the parameter.
+                self.apply_patch(patch, [name for name in removed if name not in malformed])
+                invalid.update(malformed)
+            await self.commit()
+        elif data["type"] == "patch_parameters":
+            if self.state["parameters"] is None:
+                self._pending["snapshot"] = True
+            patch, invalid = self.validate(parameters)
+            invalid.update(malformed)
+            self.apply_patch(patch, data.get("removed", ()))
+            await self.commit()
+        elif data["type"] == "set_task":
+            self.set_task(data["task"])
+            await self.commit()
+        elif data["type"] == "hello":
+            await self.resume(websocket, data)
+        elif data["type"] == "subscribe":
+            self.subscribe(websocket, data)
+        elif data["type"] == "unsubscribe":
+            self.unsubscribe(websocket, data if any(k in data for k in TOPIC_KINDS) else None)
+        elif data["type"] == "get_parameter":
+            self.reply(websocket, data, self.specific_parameter_event(data["name"]))
+            return
+        elif data["type"] == "get_parameters":
+            self.reply(websocket, data, self.parameters_reply_event(data["names"]))
+            return
+        elif "id" in data:
+            self.reply(websocket, data, {"type": "error", "error": "Unknown message type: {0}".format(data["type"])})
+            return
+        if invalid:
+            # Only the sender hears about rejected updates; everything else in the message still went through.
+            self.reply(websocket, data, {"type": "error", "error": "Invalid parameter values", "invalid": invalid})
+        elif "id" in data:
+            self.reply(websocket, data, {"type": "ack"})
+
+
+def new_pending():
+    # patch: Name -> merged changed fields; removed: Name -> last entry (for routing); task: new task or None;
+    # snapshot: True when the parameters were initialized, so everyone needs a full snapshot instead of a patch.
+    return {"patch": {}, "removed": {}, "task": None, "snapshot": False}
+
+# Message builders return dicts; they are encoded per client subprotocol by protocol.encode.
+def parameters_event(parameters, revision, epoch):
+    if parameters is None:
+        p = {"type": "parameters", "has_data": False, "parameters": "", "revision": revision, "epoch": epoch}
     else:
-        p = json.dumps({"type": "iparam", "has_data": True, "value": json.dumps(STATE['parameters'][name])})
+        p = {"type": "parameters", "has_data": True, "parameters": parameters, "revision": revision, "epoch": epoch}
     return p
 
-def task_event():
-    if STATE['task'] is None:
-        p = json.dumps({"type": "task", "has_data": False, "task": ""})
+def parameters_patch_event(patch, removed, revision):
+    # Only the changed entries go out: `patch` maps parameter Name -> changed fields.
+    return {"type": "parameters_patch", "patch": patch, "removed": list(removed), "revision": revision}
+
+def task_event(task, revision):
+    if task is None:
+        p = {"type": "task", "has_data": False, "task": "", "revision": revision}
     else:
-        p = json.dumps({"type": "task", "has_data": True, "task": STATE['task']})
+        p = {"type": "task", "has_data": True, "task": task, "revision": revision}
     return p
 
-def users_event():
-    return json.dumps({"type": "users", "count": len(USERS)})
+def diff_parameters(old, new):
+    """Return the (patch, removed) pair that turns the `old` parameters dict into `new`."""
+    patch = {}
+    for name, entry in new.items():
+        previous = old.get(name)
+        if previous is None:
+            patch[name] = entry
+            continue
+        fields = {k: v for (k, v) in entry.items() if k not in previous or previous[k] != v}
+        if fields:
+            patch[name] = fields
+    removed = [name for name in old if name not in new]
+    return patch, removed
 
-async def notify_parameters():
-    if USERS:  # asyncio.wait doesn't accept an empty list
-        message = parameters_event()
-        await asyncio.wait([user.send(message) for user in USERS])
+def split_malformed(parameters):
+    """Split a Name -> fields dict into (the entries that are dicts, Name -> reason for each one that is not)."""
+    malformed = {name: "expected an object of fields, e.g. {\"Value\": ...}"
+                 for (name, fields) in parameters.items() if not isinstance(fields, dict)}
+    if not malformed:
+        return parameters, malformed
+    return {k: v for (k, v) in parameters.items() if k not in malformed}, malformed
 
-async def notify_specific_parameter(name):
-    if USERS:
-        message = specific_parameter_event(name)
-        await asyncio.wait([user.send(message) for user in USERS])
+def compile_validator(entry):
+    """Build a function that checks a new Value for the parameter `entry`, from its Type, Bounds and Options.
 
-async def notify_task():
-    if USERS:  # asyncio.wait doesn't accept an empty list
-        message = task_event()
-        await asyncio.wait([user.send(message) for user in USERS])
+    The function returns None for a valid value or a short reason otherwise. Types without constraints accept anything.
+    """
+    kind, bounds, options = entry.get("Type"), entry.get("Bounds"), entry.get("Options")
+    if kind == "Boolean":
+        return lambda v: None if isinstance(v, bool) else "expected true or false"
+    if kind == "Label":
+        return lambda v: None if isinstance(v, str) else "expected a string"
+    if kind == "Tags":
+        return lambda v: None if isinstance(v, list) and all(isinstance(t, str) for t in v) else "expected a list of strings"
+    if kind == "Array":
+        # Bounds are not enforced on Array elements: the parameter files have arrays whose entries exceed them.
+        return lambda v: None if isinstance(v, list) and all(is_number(x) for x in v) else "expected a list of numbers"
+    if kind == "Scalar":
+        if isinstance(bounds, list) and len(bounds) == 2 and all(is_number(b) for b in bounds):
+            low, high = bounds
+            reason = "expected a number in [{0}, {1}]".format(low, high)
+            return lambda v: None if is_number(v) and low <= v <= high else reason
+        return lambda v: None if is_number(v) else "expected a number"
+    if kind in ("Dropdown", "DropdownTags") and options:
+        choices = frozenset(o for o in options if isinstance(o, str))
+        reason = "expected one of: " + ", ".join(map(str, options))
+        if kind == "Dropdown":
+            return lambda v: None if isinstance(v, str) and v in choices else reason
+        return lambda v: None if isinstance(v, list) and all(isinstance(t, str) and t in choices for t in v) else reason
+    return lambda v: None
 
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-async def notify_users():
-    if USERS:  # asyncio.wait doesn't accept an empty list
-        message = users_event()
-        await asyncio.wait([user.send(message) for user in USERS])
+def session_name(path):
+    """Session that a websocket path refers to: "/rig/3" -> "rig/3", and "/" is the default session ""."""
+    return path.split("?", 1)[0].strip("/")
 
+def get_session(name):
+    if name not in SESSIONS:
+        log = None
+        if CONFIG["state_dir"] is not None:
+            log = StateLog(os.path.join(CONFIG["state_dir"], "session-" + quote(name, safe="")))
+        SESSIONS[name] = Session(name, log)
+    return SESSIONS[name]
 
-async def register(websocket):
-    USERS.add(websocket)
-    await notify_users()
+def label(value):
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-
-async def unregister(websocket):
-    USERS.remove(websocket)
-    await notify_users()
+def worker_index(name, n_workers):
+    """Worker process that owns session `name` (stable across restarts, unlike hash())."""
+    return zlib.crc32(name.encode("utf-8")) % n_workers
 
 
 async def serve_parameters(websocket, path):
-    # register(websocket) sends user_event() to websocket
+    session = get_session(session_name(path))
     try:
-        await register(websocket)
+        # register(websocket) sends users_event() to everyone in the session
+        await session.register(websocket)
+        # A reconnecting client says `hello` first so it only gets what it missed; anyone else gets a snapshot.
+        try:
+            data = decode(await asyncio.wait_for(websocket.recv(), HELLO_WAIT))
+        except asyncio.TimeoutError:
+            data = None
+        if data is None or data["type"] != "hello":
+            await session.send_snapshot(websocket)
+        if data is not None:
+            print(data)
+            METRICS.message_received(data["type"])
+            await session.handle_message(websocket, data)
         async for message in websocket:
-            data = json.loads(message)
+            data = decode(message)
             print(data)
-            if data["type"] == "set_parameters":
-                STATE["parameters"] = json.loads(data["parameters"])
-                await notify_parameters()
-            elif data["type"] == "set_task":
-                STATE["task"] = data["task"]
-                await notify_task()
-                await notify_parameters()
-            elif data["type"] == "get_parameter":
-                await notify_specific_parameter(data["name"])
+            METRICS.message_received(data["type"])
+            await session.handle_message(websocket, data)
     except Exception:
         print("Websocket connection closed.")
     finally:
-        await unregister(websocket)
+        await session.unregister(websocket)
+
+
+async def process_request(path, request_headers):
+    """Answer plain HTTP requests for /metrics; everything else goes on to the websocket handshake."""
+    if path.split("?", 1)[0] == METRICS_PATH and request_headers.get("Upgrade", "").lower() != "websocket":
+        return HTTPStatus.OK, [("Content-Type", "text/plain; version=0.0.4")], METRICS.render().encode("utf-8")
+    return None
+
+
+async def run_server(host, port, ready=None):
+    """Serve sessions on host:port until cancelled; `ready` (optional multiprocessing queue) receives the bound port."""
+    asyncio.ensure_future(METRICS.watch_event_loop())
+    # The sessions run their own heartbeat (see Session.heartbeat), so the websockets keepalive is turned off.
+    async with websockets.serve(serve_parameters, host, port, subprotocols=SUBPROTOCOLS,
+                                process_request=process_request, ping_interval=None) as server:
+        if ready is not None:
+            ready.put(server.sockets[0].getsockname()[1])
+        await asyncio.Future()
+
+
+def run_worker(ready, config):
+    """Entry point of a worker process: serve on a free loopback port and report it back through `ready`."""
+    CONFIG.update(config)
+    asyncio.run(run_server("127.0.0.1", 0, ready))
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def fetch_metrics(worker_port):
+    """Body of a worker's /metrics response."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", worker_port)
+    writer.write("GET {0} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".format(METRICS_PATH).encode("latin-1"))
+    response = await reader.read()
+    writer.close()
+    return response.split(b"\r\n\r\n", 1)[1].decode("utf-8")
+
+
+def merge_metrics(bodies):
+    """Merge the /metrics of every worker into one exposition, adding a `worker` label to each sample."""
+    families = {}  # metric family -> (HELP/TYPE lines, samples); each family must stay contiguous in the output
+    for index, body in enumerate(bodies):
+        family = None
+        for line in body.splitlines():
+            if line.startswith(("# HELP ", "# TYPE ")):
+                family = line.split()[2]  # HELP comes first, so it must open the family too
+            if line.startswith("#"):
+                if family not in families:
+                    families[family] = ([], [])
+                if index == 0:
+                    families[family][0].append(line)
+                continue
+            name, value = line.rsplit(" ", 1)
+            if "{" in name:
+                name = name.replace("{", '{{worker="{0}",'.format(index), 1)
+            else:
+                name = '{0}{{worker="{1}"}}'.format(name, index)
+            families.setdefault(family, ([], []))[1].append("{0} {1}".format(name, value))
+    return "".join("\n".join(header + samples) + "\n" for (header, samples) in families.values())
+
+
+async def run_router(host, port, worker_ports):
+    """Accept every connection on host:port and splice it through to the worker that owns its session."""
+    async def route(reader, writer):
+        request_line = await reader.readline()  # e.g. b"GET /rig/3 HTTP/1.1\r\n"
+        try:
+            _, path, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            writer.close()
+            return
+        headers = b""
+        if path.split("?", 1)[0] == METRICS_PATH:
+            # A plain GET (not a websocket to the "metrics" session) gets the metrics of all workers together.
+            while True:
+                line = await reader.readline()
+                headers += line
+                if line in (b"\r\n", b""):
+                    break
+            if b"upgrade: websocket" not in headers.lower():
+                body = merge_metrics(await asyncio.gather(*(fetch_metrics(p) for p in worker_ports))).encode("utf-8")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+                await writer.drain()
+                writer.close()
+                return
+        worker_port = worker_ports[worker_index(session_name(path), len(worker_ports))]
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", worker_port)
+        except OSError:
+            print("Worker on port {0} is not reachable.".format(worker_port))
+            writer.close()
+            return
+        upstream_writer.write(request_line + headers)
+        await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer))
+
+    server = await asyncio.start_server(route, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parameter server that synchronizes state across clients.")
+    parser.add_argument("--host", default=WEBSOCKET_IP, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=WEBSOCKET_PORT, help="Port to listen on.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes to shard sessions across (default: 1, no sharding).")
+    parser.add_argument("--state-dir", default=SERVER_STATE_DIR,
+                        help="Directory where sessions persist their state across restarts.")
+    parser.add_argument("--in-memory", action="store_true", help="Do not persist session state to disk.")
+    parser.add_argument("--coalesce-ms", type=float, default=CONFIG["coalesce_window"] * 1000,
+                        help="Merge changes arriving within this many milliseconds into one broadcast (0 disables).")
+    parser.add_argument("--ping-interval", type=float, default=CONFIG["ping_interval"],
+                        help="Seconds between heartbeat pings to each client (0 disables the heartbeat).")
+    parser.add_argument("--ping-timeout", type=float, default=CONFIG["ping_timeout"],
+                        help="Drop clients that do not answer a ping within this many seconds.")
+    parser.add_argument("--send-timeout", type=float, default=CONFIG["send_timeout"],
+                        help="Drop clients that take longer than this many seconds to accept one message.")
+    args = parser.parse_args()
+    CONFIG["state_dir"] = None if args.in_memory else args.state_dir
+    CONFIG["coalesce_window"] = args.coalesce_ms / 1000
+    CONFIG["ping_interval"] = args.ping_interval
+    CONFIG["ping_timeout"] = args.ping_timeout
+    CONFIG["send_timeout"] = args.send_timeout
+    if args.workers <= 1:
+        asyncio.run(run_server(args.host, args.port))
+        return
+    ready = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(ready, dict(CONFIG)), daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    # Daemon workers are only reaped at a normal exit, so a SIGTERM (e.g. from load_test.py) must exit normally too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        # Sessions are assigned to workers by index, so the order the ports come back in does not matter.
+        worker_ports = [ready.get() for _ in workers]
+        asyncio.run(run_router(args.host, args.port, worker_ports))
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
 
 
-start_server = websockets.serve(serve_parameters, WEBSOCKET_IP, WEBSOCKET_PORT)
-loop = asyncio.get_event_loop()
-loop.run_until_complete(start_server)
-loop.run_forever()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
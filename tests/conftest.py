@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Interactive Tk script (opens a window and blocks in mainloop); run it by hand instead.
+collect_ignore = ["test_svg_button.py"]
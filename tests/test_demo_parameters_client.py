@@ -0,0 +1,25 @@
+""" Tests for the game-side parameter client (demo_parameters_client.py), fed server messages directly. """
+from demo_parameters_client import GameParameters
+
+
+def make_client():
+    # Skip __init__, which loads files and starts the connection thread.
+    client = object.__new__(GameParameters)
+    client._requests, client._parameters = {}, {}
+    client._revision = client._epoch = None
+    client.debug = lambda *args, **kwargs: None
+    return client
+
+
+def test_resume_revision_only_moves_with_parameters_messages():
+    client = make_client()
+    client._server_message_parser({"type": "parameters", "has_data": True, "parameters": {"a": {"Value": 1}},
+                                   "revision": 3, "epoch": "e"})
+    assert (client._revision, client._epoch) == (3, "e")
+    # Revision 4 changed the task and a parameter; the connection drops between the two messages.
+    client._server_message_parser({"type": "task", "has_data": True, "task": "x", "revision": 4})
+    assert client._revision == 3
+    client._server_message_parser({"type": "parameters_patch", "patch": {"a": {"Value": 2}}, "removed": [],
+                                   "revision": 4})
+    assert client._revision == 4
+    assert dict(client._parameters["a"]) == {"Value": 2}
@@ -0,0 +1,133 @@
+""" Tests for the headless parameters model (component.model). """
+import glob
+import json
+import os
+import pytest
+from component.model import (Parameter, ParameterModel, allocate_filename, group_by_page, next_filename, write_json,
+                             write_new_json)
+from definitions import DEFAULT_PARAMETERS_DIR
+
+
+def make_model():
+    return ParameterModel.from_dict({"parameters": [
+        {"Name": "Task", "Type": "Dropdown", "Page": "Setup", "Task": ["A", "B"], "Value": "A", "Options": ["A", "B"]},
+        {"Name": "Subject", "Type": "Label", "Page": "Setup", "Task": ["A", "B"], "Value": "Rupert"},
+        {"Name": "Trials", "Type": "Scalar", "Page": "Trials", "Task": ["A"], "Value": 10, "Bounds": [1, 100]},
+        {"Name": "Targets", "Type": "Scalar", "Page": "Trials", "Task": ["B"], "Value": 4, "Bounds": [1, 8]},
+    ], "layout": "layout.json", "icon": "CMU_Tartans"})
+
+
+@pytest.mark.parametrize("file_name", sorted(glob.glob(os.path.join(DEFAULT_PARAMETERS_DIR, "*.json"))),
+                         ids=os.path.basename)
+def test_export_round_trip(file_name):
+    with open(file_name, 'rt') as f:
+        contents = json.load(f)
+    if not isinstance(contents["parameters"], list):
+        pytest.skip("Name -> parameter form, which is exported as a list")
+    exported = ParameterModel.load(file_name).export()
+    assert exported == contents
+    # Field order within each parameter is kept too.
+    assert json.dumps(exported["parameters"], indent=2) == json.dumps(contents["parameters"], indent=2)
+
+
+def test_parameter_keeps_key_order_and_dict_behaviour():
+    p = Parameter(Value=1, Name="x", Custom="extra")
+    assert list(p) == ["Value", "Name", "Custom"]
+    assert dict(p) == {"Value": 1, "Name": "x", "Custom": "extra"}
+    assert "Description" not in p and p.get("Description") is None
+    del p["Value"]
+    p["Value"] = 2
+    assert list(p) == ["Name", "Custom", "Value"]
+    assert json.loads(json.dumps(dict(p))) == {"Name": "x", "Custom": "extra", "Value": 2}
+    with pytest.raises(KeyError):
+        p["Units"]
+
+
+def test_patch_reports_only_changed_fields_to_listeners():
+    model = make_model()
+    calls, quiet = [], []
+    model.subscribe(calls.append)
+    model.subscribe(quiet.append)
+    changed = model.patch({"Trials": {"Value": 10, "Bounds": [1, 50]}, "Subject": {"Value": "Rupert"}},
+                          exclude=quiet.append)
+    assert changed == {"Trials": {"Bounds": [1, 50]}}
+    assert calls == [changed] and quiet == []
+    assert model.parameters["Trials"]["Bounds"] == [1, 50]
+
+
+def test_for_task_views_follow_patches():
+    model = make_model()
+    assert list(model.for_task()) == ["Task", "Subject", "Trials"]
+    assert model.for_task("A") is model.for_task("A")
+    assert list(model.for_task("B")) == ["Task", "Subject", "Targets"]
+    model.patch({"Trials": {"Task": ["A", "B"]}})
+    assert "Trials" in model.for_task("B")
+    model.patch({"Rate": {"Type": "Scalar", "Page": "Trials", "Task": ["B"], "Value": 2}})
+    assert list(model.for_task("B")) == ["Task", "Subject", "Trials", "Targets", "Rate"]
+    model.patch({"Task": {"Value": "B"}})
+    assert model.values() == {"Task": "B", "Subject": "Rupert", "Trials": 10, "Targets": 4, "Rate": 2}
+
+
+def test_export_by_task_and_copy():
+    model = make_model()
+    copy = model.copy()
+    copy.patch({"Trials": {"Value": 20}})
+    assert model.parameters["Trials"]["Value"] == 10
+    exported = model.export(task="B")
+    assert [p["Name"] for p in exported["parameters"]] == ["Task", "Subject", "Targets"]
+    assert (exported["layout"], exported["icon"]) == ("layout.json", "CMU_Tartans")
+    assert list(group_by_page(model.parameters)) == ["Setup", "Trials"]
+
+
+def test_session_name_uses_naming_variables():
+    model = make_model()
+    assert model.session_name().endswith("_A")
+    model.patch({"Naming Variables": {"Type": "Tags", "Page": "Setup", "Task": ["A"], "Value": ["Subject", "Task"]}})
+    assert model.session_name().endswith("_Rupert_A")
+    assert model.session_name("B").endswith("_A") and "Rupert" not in model.session_name("B")
+
+
+def test_allocate_filename_takes_next_free_index(tmp_path):
+    for name in ("s_00.json", "s_07.json", "s_x.json", "s_03.txt", "other_12.json"):
+        (tmp_path / name).write_text("{}")
+    first = allocate_filename(str(tmp_path), "s")
+    second = allocate_filename(str(tmp_path), "s")
+    assert [os.path.basename(first), os.path.basename(second)] == ["s_08.json", "s_09.json"]
+    assert os.path.getsize(first) == 0
+
+
+
+def test_next_filename_creates_nothing(tmp_path):
+    (tmp_path / "s_04.json").write_text("{}")
+    assert os.path.basename(next_filename(str(tmp_path), "s")) == "s_05.json"
+    assert sorted(os.listdir(tmp_path)) == ["s_04.json"]
+    assert next_filename(str(tmp_path / "missing"), "s") == str(tmp_path / "missing" / "s_00.json")
+    assert not (tmp_path / "missing").exists()
+
+def test_write_json_replaces_atomically(tmp_path):
+    target = str(tmp_path / "params.json")
+    write_json(target, {"a": 1})
+    with pytest.raises(TypeError):
+        write_json(target, {"a": object()})
+    with open(target, 'rt') as f:
+        assert json.load(f) == {"a": 1}
+    assert os.listdir(str(tmp_path)) == ["params.json"]
+
+
+def test_write_new_json_never_leaves_partial_files(tmp_path):
+    (tmp_path / "s_00.json").write_text("{}")
+    filename = write_new_json(str(tmp_path), "s", {"a": 1})
+    assert os.path.basename(filename) == "s_01.json"
+    with open(filename, 'rt') as f:
+        assert json.load(f) == {"a": 1}
+    with pytest.raises(TypeError):
+        write_new_json(str(tmp_path), "s", {"a": object()})
+    assert sorted(os.listdir(str(tmp_path))) == ["s_00.json", "s_01.json"]
+
+
+def test_save_new_writes_the_task_parameters(tmp_path):
+    model = make_model()
+    filename = model.save_new(str(tmp_path), task="B")
+    assert os.path.basename(filename).endswith("_A_00.json")
+    with open(filename, 'rt') as f:
+        assert f.read() == json.dumps(model.export(task="B"), indent=2)
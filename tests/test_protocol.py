@@ -0,0 +1,39 @@
+""" Tests for the parameter server wire format (protocol.py). """
+import json
+import pytest
+import protocol
+from protocol import JSON, MSGPACK, decode, encode
+
+PARAMETERS = {"Trials": {"Name": "Trials", "Type": "Scalar", "Value": 10}}
+
+
+def test_json_nests_parameters_as_a_string():
+    frame = encode({"type": "parameters", "has_data": True, "parameters": PARAMETERS}, JSON)
+    assert isinstance(json.loads(frame)["parameters"], str)
+    assert decode(frame) == {"type": "parameters", "has_data": True, "parameters": PARAMETERS}
+
+
+def test_json_leaves_other_messages_flat():
+    message = {"type": "parameters_patch", "patch": {"Trials": {"Value": 3}}, "removed": [], "revision": 4}
+    assert json.loads(encode(message)) == message
+    assert decode(encode(message)) == message
+
+
+def test_json_empty_nested_field_stays_empty():
+    message = {"type": "iparam", "has_data": False, "value": ""}
+    assert decode(encode(message, None)) == message
+
+
+def test_json_accepts_already_nested_strings():
+    # Older clients send the nested JSON string themselves.
+    frame = json.dumps({"type": "set_parameters", "parameters": json.dumps(PARAMETERS)})
+    assert decode(frame)["parameters"] == PARAMETERS
+    assert encode(decode(frame)) == encode({"type": "set_parameters", "parameters": PARAMETERS})
+
+
+@pytest.mark.skipif(protocol.msgpack is None, reason="msgpack is not installed")
+def test_msgpack_round_trip():
+    message = {"type": "set_parameters", "parameters": PARAMETERS, "id": 7}
+    frame = encode(message, MSGPACK)
+    assert isinstance(frame, bytes)
+    assert decode(frame) == message
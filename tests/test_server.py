@@ -0,0 +1,158 @@
+""" Tests for the parameter server's session logic (server.py), without opening any sockets. """
+import asyncio
+import pytest
+import server
+from protocol import decode
+
+
+class FakeClient:
+    """Stands in for server.Client: keeps what would have been sent."""
+    subprotocol = server.JSON
+
+    def __init__(self):
+        self.sent = []
+
+    def push(self, message, slot=None, kind=None):
+        self.sent.append(decode(message))
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setitem(server.CONFIG, "coalesce_window", 0)
+    return server.Session("test")
+
+
+def connect(session, topics=None):
+    websocket = object()
+    session.users[websocket] = FakeClient()
+    session.unfiltered.add(websocket)
+    if topics:
+        session.subscribe(websocket, topics)
+    return websocket
+
+
+def handle(session, websocket, message):
+    asyncio.run(session.handle_message(websocket, message))
+    return session.users[websocket].sent if websocket in session.users else None
+
+
+PARAMETERS = {"a": {"Name": "a", "Type": "Scalar", "Page": "P", "Task": ["x"], "Value": 1, "Bounds": [0, 10]},
+              "b": {"Name": "b", "Type": "Label", "Page": "Q", "Task": ["y"], "Value": "B"}}
+
+
+def test_diff_parameters():
+    new = {"a": {**PARAMETERS["a"], "Value": 2}, "c": {"Value": 3}}
+    assert server.diff_parameters(PARAMETERS, new) == ({"a": {"Value": 2}, "c": {"Value": 3}}, ["b"])
+
+
+def test_malformed_entries_get_an_error_and_keep_the_connection(session):
+    websocket = connect(session)
+    sent = handle(session, websocket, {"type": "set_parameters", "parameters": {"param1": "A", "param2": 5}})
+    assert sent[-1]["type"] == "error" and sorted(sent[-1]["invalid"]) == ["param1", "param2"]
+    assert session.state["parameters"] is None
+    handle(session, websocket, {"type": "set_parameters", "parameters": {"param1": {"Value": "A"}}})
+    sent = handle(session, websocket, {"type": "set_parameters", "parameters": {"param1": "B"}})
+    assert list(sent[-1]["invalid"]) == ["param1"]
+    assert session.state["parameters"] == {"param1": {"Value": "A"}}
+    sent = handle(session, websocket, {"type": "patch_parameters", "patch": ["param1"], "id": 5})
+    assert sent[-1] == {"type": "error", "error": "Expected an object of Name -> fields", "id": 5}
+
+
+def test_snapshot_survives_clients_joining_while_it_is_encoded(session):
+    # Snapshots of more than THREADED_ENCODE_SIZE parameters are encoded on a thread, which lets others connect.
+    parameters = {"p{0}".format(i): {"Value": i} for i in range(server.THREADED_ENCODE_SIZE + 1)}
+    editor = connect(session)
+
+    async def run():
+        task = asyncio.ensure_future(session.handle_message(editor, {"type": "set_parameters", "parameters": parameters}))
+        await asyncio.sleep(0)
+        newcomer = connect(session)
+        await task
+        return newcomer
+
+    newcomer = asyncio.run(run())
+    assert session.users[editor].sent[-1]["parameters"] == parameters
+    assert newcomer in session.users
+
+
+def test_changes_since_merges_history(session):
+    websocket = connect(session)
+    handle(session, websocket, {"type": "set_parameters", "parameters": PARAMETERS})
+    handle(session, websocket, {"type": "patch_parameters", "patch": {"a": {"Value": 2}}})
+    handle(session, websocket, {"type": "set_task", "task": "x"})
+    handle(session, websocket, {"type": "patch_parameters", "patch": {"a": {"Value": 3}, "c": {"Value": 0}},
+                                "removed": ["b"]})
+    assert session.state["revision"] == 4
+    patch, removed, task = session.changes_since(1)
+    assert patch == {"a": {"Value": 3}, "c": {"Value": 0}}
+    assert removed == {"b": PARAMETERS["b"]}
+    assert task == "x"
+    assert session.changes_since(4) == ({}, {}, None)
+    assert session.changes_since(5) is None
+
+
+def test_changes_since_gives_up_once_history_is_gone(session):
+    websocket = connect(session)
+    session.history = server.deque(maxlen=2)
+    for value in range(4):
+        handle(session, websocket, {"type": "patch_parameters", "patch": {"a": {"Value": value}}})
+    assert session.changes_since(1) is None
+    assert session.changes_since(2) == ({"a": {"Value": 3}}, {}, None)
+
+
+def test_resume_sends_removals_to_page_subscribers(session):
+    editor = connect(session)
+    handle(session, editor, {"type": "set_parameters", "parameters": PARAMETERS})
+    since = session.state["revision"]
+    reader = connect(session, {"pages": ["P"]})
+    handle(session, editor, {"type": "patch_parameters", "patch": {"b": {"Value": "C"}}, "removed": ["a"]})
+    live = session.users[reader].sent[-1]
+    assert (live["patch"], live["removed"]) == ({}, ["a"])
+    asyncio.run(session.resume(reader, {"type": "hello", "since": since, "epoch": session.state["epoch"]}))
+    resumed = session.users[reader].sent[-1]
+    assert (resumed["patch"], resumed["removed"]) == ({}, ["a"])
+
+
+def test_requests_with_an_id_get_one_reply(session):
+    websocket = connect(session)
+    handle(session, websocket, {"type": "set_parameters", "parameters": PARAMETERS})
+    sent = handle(session, websocket, {"type": "get_parameters", "names": ["a", "z"], "id": 3})
+    assert sent[-1] == {"type": "iparams", "parameters": {"a": PARAMETERS["a"]}, "missing": ["z"], "id": 3}
+    sent = handle(session, websocket, {"type": "set_task", "task": "x", "id": 4})
+    assert sent[-1] == {"type": "ack", "id": 4}
+
+
+def test_merge_metrics_keeps_families_together():
+    body = ("# HELP a_users Users.\n# TYPE a_users gauge\na_users{session=\"s\"} 1\n"
+            "# HELP b_rev Revision.\n# TYPE b_rev gauge\nb_rev 3\n")
+    assert server.merge_metrics([body, body]).splitlines() == [
+        "# HELP a_users Users.", "# TYPE a_users gauge",
+        'a_users{worker="0",session="s"} 1', 'a_users{worker="1",session="s"} 1',
+        "# HELP b_rev Revision.", "# TYPE b_rev gauge",
+        'b_rev{worker="0"} 3', 'b_rev{worker="1"} 3']
+
+
+@pytest.mark.parametrize("entry, good, bad", [
+    ({"Type": "Boolean"}, [True, False], [1, "true"]),
+    ({"Type": "Label"}, ["", "text"], [3, None]),
+    ({"Type": "Tags"}, [[], ["a", "b"]], ["a", [1]]),
+    ({"Type": "Array"}, [[], [1, 2.5]], [[True], ["1"], 1]),
+    ({"Type": "Scalar", "Bounds": [0, 10]}, [0, 10, 2.5], [-1, 11, True, "5"]),
+    ({"Type": "Scalar"}, [-1e9, 3], [None, False]),
+    ({"Type": "Dropdown", "Options": ["A", "B"]}, ["A"], ["C", ["A"]]),
+    ({"Type": "DropdownTags", "Options": ["A", "B"]}, [[], ["A", "B"]], ["A", ["C"]]),
+    ({"Type": "Object"}, [{}, 1, "anything"], []),
+])
+def test_compile_validator(entry, good, bad):
+    validator = server.compile_validator(entry)
+    assert [validator(v) for v in good] == [None] * len(good)
+    assert all(isinstance(validator(v), str) for v in bad)
+
+
+def test_invalid_values_are_rejected_and_reported(session):
+    websocket = connect(session)
+    handle(session, websocket, {"type": "set_parameters", "parameters": PARAMETERS})
+    sent = handle(session, websocket, {"type": "patch_parameters", "patch": {"a": {"Value": 11}, "b": {"Value": "D"}}})
+    assert sent[-1]["type"] == "error" and list(sent[-1]["invalid"]) == ["a"]
+    assert session.state["parameters"]["a"]["Value"] == 1
+    assert session.state["parameters"]["b"]["Value"] == "D"